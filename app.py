@@ -1,9 +1,8 @@
 from src.config import Config
-from src import connect, Config, App
+from src import connect, Config, App, CircuitOpen
 from time import sleep
 from dotenv import load_dotenv
 from io import StringIO
-from http.client import IncompleteRead
 import logging
 import traceback
 import sys
@@ -36,11 +35,9 @@ if __name__ == '__main__':
     while True:
         try:
             app.sync()
-        except IncompleteRead:
-            logging.warning(
-                'Failed to fetch following. Incomplete read. Shutting down ...')
-            logging.exception(traceback.format_exc())
-            break
+        except CircuitOpen as e:
+            # Upstream kept failing after retries, try again next run
+            logging.warning(str(e))
         except Exception:
             logging.exception(traceback.format_exc())
 
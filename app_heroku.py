@@ -1,11 +1,10 @@
 from src.config import Config
-from src import connect, Config, App
+from src import connect, Config, App, CircuitOpen
 from dotenv import load_dotenv
 from threading import Event
 import logging
 import traceback
 import sys
-from http.client import IncompleteRead
 
 exit = Event()
 
@@ -28,11 +27,9 @@ def main():
     while not exit.is_set():
         try:
             app.sync()
-        except IncompleteRead:
-            logging.warning(
-                'Failed to fetch following. Incomplete read. Shutting down ...')
-            logging.exception(traceback.format_exc())
-            exit.set()
+        except CircuitOpen as e:
+            # Upstream kept failing after retries, try again next run
+            logging.warning(str(e))
         except Exception:
             logging.exception(traceback.format_exc())
 
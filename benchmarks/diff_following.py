@@ -0,0 +1,38 @@
+"""Compare Following.diff with the old username set diff.
+
+Usage: python -m benchmarks.diff_following [following_count]
+"""
+from timeit import timeit
+from typing import List
+from src.twitter import Account, Following
+import random
+import sys
+
+
+def set_diff(new: List[str], old: List[str]):
+    return list(set(new) - set(old)), list(set(old) - set(new))
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    changes = max(1, count // 100)
+
+    old_ids = random.sample(range(10**6, 10**18), count)
+    new_ids = old_ids[changes:] + random.sample(range(10**6, 10**18), changes)
+
+    old_accounts = [Account(id, f"user{id}", "") for id in old_ids]
+    new_accounts = [Account(id, f"user{id}", "") for id in new_ids]
+
+    old_following = Following(old_ids)
+    new_following = Following(accounts=new_accounts)
+
+    runs = 20
+
+    usernames = timeit(lambda: set_diff([account.username for account in new_accounts], [
+                       account.username for account in old_accounts]), number=runs) / runs
+    ids = timeit(lambda: new_following.diff(old_following),
+                 number=runs) / runs
+
+    print(f"{count} following, {changes} followed and {changes} unfollowed")
+    print(f"username set diff: {usernames*1000:.2f} ms")
+    print(f"Following.diff:    {ids*1000:.2f} ms")
@@ -1,6 +1,8 @@
 from .config import Config
+from .cache import TTLCache
+from .retry import RetryPolicy, UpstreamError, CircuitOpen, get_policy
 from .twitter import User, API as TwitterAPI
-from .database import UserDocument, Configuration, connect, UserPair, Leaderboard
+from .database import UserDocument, ProfileDocument, FollowingCheckpoint, FollowEvent, PendingFollowing, OutboxRecord, Configuration, connect, UserPair, Leaderboard
 from .scorer import Scorer
 from .airtable import Airtable, NewFollowing
 from .main import App
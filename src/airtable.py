@@ -1,9 +1,15 @@
-from typing import Callable, Dict, List, TypedDict
+from typing import Dict, List, Optional, TypedDict
 from src.config import Config
-from src import Leaderboard
-from datetime import datetime
+from src import Leaderboard, OutboxRecord
+from src.retry import UpstreamError, classify, get_policy, parse_retry_after
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 from urllib.parse import quote
-from time import sleep
+from threading import Lock, Thread
+from time import monotonic, sleep
+import logging
+import random
+from requests.adapters import HTTPAdapter  # type: ignore
 import requests  # type: ignore
 
 
@@ -70,118 +76,210 @@ def convert_leaderboard(source: NewFollowing) -> Dict:
     }
 
 
+class TokenBucket:
+    """Thread safe token bucket. Allows bursts of capacity requests, then rate requests per second
+    """
+    rate: float
+    capacity: float
+    _tokens: float
+    _updated: float
+    _lock: Lock
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = monotonic()
+        self._lock = Lock()
+
+    def acquire(self):
+        """Take one token. Blocks until a token is available
+        """
+        while True:
+            with self._lock:
+                now = monotonic()
+                self._tokens = min(
+                    self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+
+                wait = (1 - self._tokens) / self.rate
+
+            sleep(wait)
+
+
+_base_limiters: Dict[str, TokenBucket] = {}
+_base_limiters_lock = Lock()
+
+
+def get_base_limiter(app_id: str) -> TokenBucket:
+    """Get request limiter of Airtable base. Airtable limits requests per base, so every client of the same base shares it
+
+    Args:
+        app_id (str): Airtable base id
+
+    Returns:
+        TokenBucket: Shared limiter
+    """
+    with _base_limiters_lock:
+        if app_id not in _base_limiters:
+            _base_limiters[app_id] = TokenBucket(
+                Airtable.REQUESTS_PER_SECOND, Airtable.REQUESTS_PER_SECOND)
+
+        return _base_limiters[app_id]
+
+
 class Airtable:
+    # Airtable API limit per base
+    REQUESTS_PER_SECOND = 5
+    # Maximum records per create or delete request
+    CHUNK_SIZE = 10
+    TIMEOUT = 30
+    # Airtable asks to wait 30 seconds after 429 without sending Retry-After
+    RATE_LIMITED_WAIT = 30
+    # Seconds between outbox flushes and the backoff of failed records
+    OUTBOX_FLUSH_INTERVAL = 10
+    OUTBOX_BACKOFF = 30
+    OUTBOX_MAX_BACKOFF = 60*60
+    OUTBOX_LEASE_DURATION = 5*60
+    # Attempts after which a record that keeps failing is parked
+    OUTBOX_MAX_ATTEMPTS = 10
+
     config: Config
     base_url: str
     token: str
+    session: requests.Session
+    limiter: TokenBucket
+    flusher: Optional[Thread]
+    merge_fields: Dict[str, List[str]]
 
     def __init__(self, config: Config):
         self.config = config
         self.base_url = f'https://api.airtable.com/v0/{config.AIRTABLE_APP_ID}'
         self.token = config.AIRTABLE_API_KEY
+        self.limiter = get_base_limiter(config.AIRTABLE_APP_ID)
+        self.flusher = None
+
+        # Fields that identify a row of outbox tables, so resent records are not duplicated
+        self.merge_fields = {
+            config.AIRTABLE_TABLE_LEADERBOARD: ["Username"],
+            config.AIRTABLE_TABLE_RESULT: [
+                "Username", "Followed By", "Following Date"]
+        }
 
-    def _get_table_content(self, table: str) -> List[Dict]:
-        result: List[Dict[str, Dict]] = []
-        next_token = ''
+        # Keep-alive connections are reused by every request, including concurrent table writes
+        self.session = requests.Session()
+        self.session.headers.update({'Authorization': f'Bearer {self.token}'})
+        adapter = HTTPAdapter(pool_connections=1,
+                              pool_maxsize=self.REQUESTS_PER_SECOND)
+        self.session.mount('https://', adapter)
 
-        while True:
+    def _request(self, method: str, table: str, **kwargs) -> Dict:
+        """Send request to a table once the base limiter allows it. Transient errors are retried by the Airtable retry policy
 
-            if next_token == '':
-                response = requests.get(f"{self.base_url}/{quote(table)}",
-                                        headers={'Authorization': f'Bearer {self.token}'})
-            else:
-                response = requests.get(f"{self.base_url}/{quote(table)}",
-                                        headers={
-                                            'Authorization': f'Bearer {self.token}'},
-                                        params={"offset": next_token}
-                                        )
+        Args:
+            method (str): HTTP method
+            table (str): Table name
 
-                sleep(0.5)
+        Raises:
+            UpstreamError: Response is not ok
+            CircuitOpen: Airtable failed too often recently
+
+        Returns:
+            Dict: Response payload
+        """
+        def send() -> Dict:
+            self.limiter.acquire()
+
+            response = self.session.request(
+                method, f"{self.base_url}/{quote(table)}", timeout=self.TIMEOUT, **kwargs)
 
             if not response.ok:
-                raise Exception(response.text)
+                retry_after = parse_retry_after(
+                    response.headers.get("Retry-After"))
 
-            response_payload = response.json()
+                if response.status_code == 429 and retry_after is None:
+                    retry_after = self.RATE_LIMITED_WAIT
 
-            result.extend(response_payload["records"])
+                raise UpstreamError(
+                    response.text, response.status_code, retry_after)
 
-            if "offset" in response_payload:
-                next_token = response_payload["offset"]
-            else:
-                break
+            return response.json()
+
+        return get_policy("airtable").call(send)
 
-        return [row["fields"] for row in result if len(row["fields"].keys()) != 0]
+    def _get_table_content(self, table: str) -> List[Dict]:
+        return [row["fields"] for row in self._get_raw_table_content(table)]
 
     def _get_raw_table_content(self, table: str) -> List[Dict]:
         result: List[Dict[str, Dict]] = []
-        next_token = ''
+        params: Dict = {}
 
         while True:
-
-            if next_token == '':
-                response = requests.get(f"{self.base_url}/{quote(table)}",
-                                        headers={'Authorization': f'Bearer {self.token}'})
-            else:
-                response = requests.get(f"{self.base_url}/{quote(table)}",
-                                        headers={
-                                            'Authorization': f'Bearer {self.token}'},
-                                        params={"offset": next_token}
-                                        )
-
-                sleep(0.5)
-
-            if not response.ok:
-                raise Exception(response.text)
-
-            response_payload = response.json()
+            response_payload = self._request("GET", table, params=params)
 
             result.extend(response_payload["records"])
 
             if "offset" in response_payload:
-                next_token = response_payload["offset"]
+                params["offset"] = response_payload["offset"]
             else:
                 break
 
         return [row for row in result if len(row["fields"].keys()) != 0]
 
-    def _add_rows(self, table: str, data: List[NewFollowing], converter: Callable[[NewFollowing], Dict]):
-        """Save new list of data to airtable
+    def _upsert_rows(self, table: str, records: List[Dict], fields_to_merge_on: List[str]):
+        """Create or update records, matched on fields_to_merge_on. Sending the same records
+        again updates the rows created by the first request instead of duplicating them
 
         Args:
-            data (List[Dict]): [description]
+            table (str): Table name
+            records (List[Dict]): Record fields, at most CHUNK_SIZE
+            fields_to_merge_on (List[str]): Fields that identify a row
 
         Raises:
-            Exception: [description]
+            Exception: Airtable responded with error
         """
-        for chunk in [data[i:i + 10] for i in range(0, len(data), 10)]:
-            response = requests.post(f"{self.base_url}/{quote(table)}", json={"records": [
-                converter(datum) for datum in chunk]}, headers={'Authorization': f'Bearer {self.token}'})
-            if not response.ok:
-                raise Exception(response.text)
-            sleep(0.5)
+        self._request("PATCH", table, json={
+            "performUpsert": {"fieldsToMergeOn": fields_to_merge_on},
+            "records": [{"fields": fields} for fields in records]
+        })
 
     def _delete_rows(self, table: str, data: List[str]):
-        for chunk in [data[i:i + 10] for i in range(0, len(data), 10)]:
-            response = requests.post(f"{self.base_url}/{quote(table)}", json={
-                                     "records": data}, headers={'Authorization': f'Bearer {self.token}'})
-            if not response.ok:
-                raise Exception(response.text)
-            sleep(0.5)
+        """Delete records of table
+
+        Args:
+            table (str): Table name
+            data (List[str]): Record ids
+        """
+        for chunk in [data[i:i + self.CHUNK_SIZE] for i in range(0, len(data), self.CHUNK_SIZE)]:
+            self._request("DELETE", table, params={"records[]": chunk})
 
     def _filter_leaderboard(self, data: List[NewFollowing]):
+        """Admit users that score at least SCORE_OFFSET and are not in leaderboard yet
+
+        Args:
+            data (List[NewFollowing]): New following
+
+        Returns:
+            List[NewFollowing]: Newly admitted users
+        """
         new_following: List[str] = []
-        in_leaderboard = [user.username for user in Leaderboard.objects(
-            username__in=[user["followed_user"] for user in data])]
-        filtered: List[NewFollowing] = []
+        candidates: List[NewFollowing] = []
 
         for user in data:
-            if user["followed_user"] not in new_following and user["followed_user"] not in in_leaderboard:
+            if user["followed_user"] not in new_following:
                 new_following.append(user["followed_user"])
 
                 if user["url_points"]+user["followers_count_points"]+user["created_at_points"]+user["tracked_user_points"]+user["description_points"] >= self.config.SCORE_OFFSET:
-                    filtered.append(user)
+                    candidates.append(user)
 
-        return filtered
+        admitted = Leaderboard.admit(
+            [user["followed_user"] for user in candidates])
+
+        return [user for user in candidates if user["followed_user"] in admitted]
 
     def get_tracked_users(self):
         return self._get_table_content(self.config.AIRTABLE_TABLE_TRACKED_USERS)
@@ -189,21 +287,164 @@ class Airtable:
     def get_keywords(self):
         return self._get_table_content(self.config.AIRTABLE_TABLE_KEYWORDS)
 
-    def save_raw(self, data: List[NewFollowing]):
-        self._add_rows(self.config.AIRTABLE_TABLE_RESULT,
-                       data, convert_raw_data)
+    def enqueue_following(self, data: List[NewFollowing]):
+        """Store new following to result table and admitted users to leaderboard in the outbox.
+        They are sent to Airtable by the outbox flusher, see start_flusher
+
+        Args:
+            data (List[NewFollowing]): New following
+        """
+        leaderboard = self.config.AIRTABLE_TABLE_LEADERBOARD
+        result = self.config.AIRTABLE_TABLE_RESULT
+
+        OutboxRecord.enqueue(leaderboard, {
+            f"{leaderboard}:{user['followed_user']}": convert_leaderboard(user)["fields"] for user in self._filter_leaderboard(data)})
+        OutboxRecord.enqueue(result, {
+            f"{result}:{user['tracked_user']}:{user['followed_user']}:{user['followed_at'].strftime('%Y-%m-%d')}": convert_raw_data(user)["fields"] for user in data})
+
+    def _get_next_attempt_at(self, attempts: int, retry_after: Optional[float] = None) -> datetime:
+        """Get time of next attempt with jittered exponential backoff
+
+        Args:
+            attempts (int): Failed attempts so far
+            retry_after (Optional[float], optional): Seconds Airtable asked to wait. Defaults to None.
+
+        Returns:
+            datetime: Next attempt time
+        """
+        backoff = min(self.OUTBOX_BACKOFF * 2 ** attempts,
+                      self.OUTBOX_MAX_BACKOFF)
+
+        return datetime.utcnow() + timedelta(seconds=max(random.uniform(backoff / 2, backoff), retry_after or 0))
+
+    def _flush_table(self, table: str, owner: str) -> int:
+        """Send outbox records of a table in batches of CHUNK_SIZE until none is due
+
+        Args:
+            table (str): Table name
+            owner (str): Flusher id
+
+        Returns:
+            int: Number of sent records
+        """
+        sent = 0
+
+        while True:
+            records = OutboxRecord.claim(table, owner, self.CHUNK_SIZE, timedelta(
+                seconds=self.OUTBOX_LEASE_DURATION))
+
+            if len(records) == 0:
+                return sent
+
+            try:
+                self._upsert_rows(table, [record["fields"] for record in records],
+                                  self.merge_fields[table])
+            except Exception as e:
+                if not isinstance(e, UpstreamError) or classify(e)[0]:
+                    self._retry_later(table, records, e)
+                    return sent
+
+                # Airtable rejected the batch. Records are resent one by one, so one bad record
+                # does not fail the records it was claimed with
+                sent += self._send_each(table, records)
+                continue
 
-    def save_leaderboard(self, data: List[NewFollowing]):
-        filtered = self._filter_leaderboard(data)
+            OutboxRecord.complete([record["_id"] for record in records])
+            sent += len(records)
 
-        for user in filtered:
-            Leaderboard(username=user["followed_user"]).save()
+    def _send_each(self, table: str, records: List[Dict]) -> int:
+        """Send claimed records one request each. Records that Airtable rejects are parked
 
-        self._add_rows(self.config.AIRTABLE_TABLE_LEADERBOARD,
-                       filtered, convert_leaderboard)
+        Args:
+            table (str): Table name
+            records (List[Dict]): Claimed records
+
+        Returns:
+            int: Number of sent records
+        """
+        sent = 0
+
+        for record in records:
+            try:
+                self._upsert_rows(
+                    table, [record["fields"]], self.merge_fields[table])
+            except UpstreamError as e:
+                if classify(e)[0]:
+                    self._retry_later(table, [record], e)
+                else:
+                    logging.error(
+                        f"Airtable rejected record {record['key']} of {table}. Parking it: {e}")
+                    OutboxRecord.park([record], str(e))
+                continue
+            except Exception as e:
+                self._retry_later(table, [record], e)
+                continue
+
+            OutboxRecord.complete([record["_id"]])
+            sent += 1
+
+        return sent
+
+    def _retry_later(self, table: str, records: List[Dict], error: Exception):
+        """Reschedule records of a failed attempt with backoff. Records that reached OUTBOX_MAX_ATTEMPTS are parked
+
+        Args:
+            table (str): Table name
+            records (List[Dict]): Claimed records
+            error (Exception): Error of the failed attempt
+        """
+        exhausted = [record for record in records if record.get(
+            "attempts", 0) + 1 >= self.OUTBOX_MAX_ATTEMPTS]
+        retried = [record for record in records if record.get(
+            "attempts", 0) + 1 < self.OUTBOX_MAX_ATTEMPTS]
+
+        if len(retried) > 0:
+            attempts = max(record.get("attempts", 0) for record in retried)
+            logging.warning(
+                f"Failed to send {len(retried)} records to {table}, attempt {attempts + 1}: {error}")
+            retry_after = classify(error)[1]
+            OutboxRecord.reschedule(retried, {record["_id"]: self._get_next_attempt_at(
+                record.get("attempts", 0), retry_after) for record in retried}, str(error))
+
+        if len(exhausted) > 0:
+            logging.error(
+                f"Failed to send {len(exhausted)} records to {table} {self.OUTBOX_MAX_ATTEMPTS} times. Parking them: {error}")
+            OutboxRecord.park(exhausted, str(error))
+
+    def flush_outbox(self, owner: str) -> int:
+        """Send due outbox records of every table. Tables are flushed at once and interleave through the base limiter
+
+        Args:
+            owner (str): Flusher id
+
+        Returns:
+            int: Number of sent records
+        """
+        with ThreadPoolExecutor(max_workers=len(self.merge_fields)) as executor:
+            return sum(executor.map(lambda table: self._flush_table(
+                table, owner), self.merge_fields))
+
+    def _run_flusher(self, owner: str):
+        while True:
+            try:
+                sent = self.flush_outbox(owner)
+
+                if sent > 0:
+                    logging.info(f"Sent {sent} records to Airtable")
+            except Exception:
+                logging.exception("Failed to flush Airtable outbox")
+
+            sleep(self.OUTBOX_FLUSH_INTERVAL)
+
+    def start_flusher(self, owner: str):
+        """Drain the outbox to Airtable in a background thread
+
+        Args:
+            owner (str): Flusher id, unique per process
+        """
+        if self.flusher is not None:
+            return
 
-    def save(self, data: List[NewFollowing]):
-        self._add_rows(self.config.AIRTABLE_TABLE_RESULT,
-                       data, convert_raw_data)
-        self._add_rows(self.config.AIRTABLE_TABLE_LEADERBOARD,
-                       data, convert_leaderboard)
+        self.flusher = Thread(target=self._run_flusher, args=(
+            owner,), name="airtable-outbox", daemon=True)
+        self.flusher.start()
@@ -0,0 +1,92 @@
+from typing import Any, Dict, Hashable, Iterable, Optional, Tuple
+from collections import OrderedDict
+from threading import Lock
+from time import time
+
+
+class TTLCache:
+    """Thread safe LRU cache with optional time to live. Least recently used entry
+    is evicted when the cache is full, expired entries are dropped when read.
+    """
+    maxsize: int
+    ttl: Optional[float]
+    hits: int
+    misses: int
+    _lock: Lock
+    _data: 'OrderedDict[Hashable, Tuple[float, Any]]'
+
+    def __init__(self, maxsize: int, ttl: Optional[float] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = Lock()
+        self._data = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Get cached value and mark it as recently used
+
+        Args:
+            key (Hashable): Cache key
+            default (Any, optional): Value returned on miss. Defaults to None.
+
+        Returns:
+            Any: Cached value or default
+        """
+        with self._lock:
+            entry = self._data.get(key)
+
+            if entry is None or (self.ttl is not None and entry[0] + self.ttl < time()):
+                if entry is not None:
+                    del self._data[key]
+                self.misses += 1
+                return default
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def get_many(self, keys: Iterable[Hashable]) -> Dict[Hashable, Any]:
+        """Get cached values of keys. Missing keys are left out
+
+        Args:
+            keys (Iterable[Hashable]): Cache keys
+
+        Returns:
+            Dict[Hashable, Any]: Key to cached value
+        """
+        result: Dict[Hashable, Any] = {}
+        missing = object()
+
+        for key in keys:
+            value = self.get(key, missing)
+            if value is not missing:
+                result[key] = value
+
+        return result
+
+    def set(self, key: Hashable, value: Any, stored_at: Optional[float] = None):
+        """Cache value
+
+        Args:
+            key (Hashable): Cache key
+            value (Any): Value
+            stored_at (Optional[float], optional): Timestamp TTL counts from. Defaults to now.
+        """
+        with self._lock:
+            self._data[key] = (stored_at if stored_at is not None else time(), value)
+            self._data.move_to_end(key)
+
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        """Drop every entry and reset counters
+        """
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
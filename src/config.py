@@ -1,5 +1,14 @@
-from os import getenv
-from typing import List
+from os import getenv, getpid
+from socket import gethostname
+from typing import List, TypedDict
+
+
+class Credential(TypedDict):
+    bearer_token: str
+    consumer_key: str
+    consumer_secret: str
+    access_token: str
+    access_token_secret: str
 
 
 class Config:
@@ -8,6 +17,7 @@ class Config:
     TWITTER_OAUTH_TOKEN: str = ''
     TWITTER_OAUTH_SECRET: str = ''
     TWITTER_BEARER_TOKEN: str = ''
+    TWITTER_CREDENTIALS: List[Credential]
 
     MONGODB_DB_NAME: str
     MONGODB_DB_HOST: str
@@ -21,15 +31,31 @@ class Config:
 
     SYNC_INTERVAL: int
     SYNC_COUNT: int = 4
+    SYNC_CONCURRENCY: int = 4
+    FULL_SYNC_INTERVAL: int
+    REVISIT_INTERVAL: int = 24*60*60
+
+    BOOTSTRAP_CONCURRENCY: int = 2
+    BOOTSTRAP_RATE_SHARE: float = 0.5
+
+    WORKER_ID: str
+    LEASE_DURATION: int = 60*60
 
     SCORE_OFFSET: int = 0
 
+    PROFILE_CACHE_TTL: int = 24*60*60
+    PROFILE_CACHE_SIZE: int = 10000
+    PROFILE_CACHE_PERSIST: bool = True
+
+    SCORE_CACHE_SIZE: int = 10000
+
     def __init__(self):
         self.TWITTER_CUSTOMER_KEY = getenv('TWITTER_CUSTOMER_KEY')
         self.TWITTER_CUSTOMER_SECRET = getenv('TWITTER_CUSTOMER_SECRET')
         self.TWITTER_OAUTH_TOKEN = getenv('TWITTER_OAUTH_TOKEN')
         self.TWITTER_OAUTH_SECRET = getenv('TWITTER_OAUTH_SECRET')
         self.TWITTER_BEARER_TOKEN = getenv('TWITTER_BEARER_TOKEN')
+        self.TWITTER_CREDENTIALS = self._get_twitter_credentials()
 
         self.MONGODB_DB_NAME = getenv('MONGODB_DB_NAME')
         self.MONGODB_DB_HOST = getenv('MONGODB_DB_HOST')
@@ -54,4 +80,90 @@ class Config:
         except ValueError:
             self.SYNC_COUNT = 4
 
+        try:
+            self.SYNC_CONCURRENCY = max(
+                1, int(getenv('SYNC_CONCURRENCY', 4)))
+        except ValueError:
+            self.SYNC_CONCURRENCY = 4
+
+        try:
+            self.FULL_SYNC_INTERVAL = int(
+                getenv('FULL_SYNC_INTERVAL', 24))*60*60
+        except ValueError:
+            self.FULL_SYNC_INTERVAL = 24*60*60
+
+        try:
+            self.REVISIT_INTERVAL = int(
+                getenv('REVISIT_INTERVAL', 24))*60*60
+        except ValueError:
+            self.REVISIT_INTERVAL = 24*60*60
+
+        try:
+            self.BOOTSTRAP_CONCURRENCY = max(
+                1, int(getenv('BOOTSTRAP_CONCURRENCY', 2)))
+        except ValueError:
+            self.BOOTSTRAP_CONCURRENCY = 2
+
+        try:
+            self.BOOTSTRAP_RATE_SHARE = min(
+                max(float(getenv('BOOTSTRAP_RATE_SHARE', 0.5)), 0.05), 1.0)
+        except ValueError:
+            self.BOOTSTRAP_RATE_SHARE = 0.5
+
+        self.WORKER_ID = getenv('WORKER_ID', f"{gethostname()}:{getpid()}")
+
+        try:
+            self.LEASE_DURATION = int(getenv('LEASE_DURATION', 60))*60
+        except ValueError:
+            self.LEASE_DURATION = 60*60
+
         self.SCORE_OFFSET = int(getenv("SCORE_OFFSET", 0))
+
+        try:
+            self.PROFILE_CACHE_TTL = int(
+                getenv('PROFILE_CACHE_TTL', 24))*60*60
+        except ValueError:
+            self.PROFILE_CACHE_TTL = 24*60*60
+
+        try:
+            self.PROFILE_CACHE_SIZE = int(getenv('PROFILE_CACHE_SIZE', 10000))
+        except ValueError:
+            self.PROFILE_CACHE_SIZE = 10000
+
+        self.PROFILE_CACHE_PERSIST = getenv(
+            'PROFILE_CACHE_PERSIST', 'true').lower() in ('1', 'true', 'yes')
+
+        try:
+            self.SCORE_CACHE_SIZE = int(getenv('SCORE_CACHE_SIZE', 10000))
+        except ValueError:
+            self.SCORE_CACHE_SIZE = 10000
+
+    def _get_twitter_credentials(self) -> List[Credential]:
+        """Collect Twitter credential sets. First set is the unsuffixed TWITTER_* keys,
+        additional sets use _2, _3, ... suffix. Bearer token falls back to the first set.
+
+        Returns:
+            List[Credential]: List of credential set
+        """
+        credentials: List[Credential] = [Credential(
+            bearer_token=self.TWITTER_BEARER_TOKEN,
+            consumer_key=self.TWITTER_CUSTOMER_KEY,
+            consumer_secret=self.TWITTER_CUSTOMER_SECRET,
+            access_token=self.TWITTER_OAUTH_TOKEN,
+            access_token_secret=self.TWITTER_OAUTH_SECRET
+        )]
+
+        index = 2
+
+        while getenv(f'TWITTER_CUSTOMER_KEY_{index}'):
+            credentials.append(Credential(
+                bearer_token=getenv(
+                    f'TWITTER_BEARER_TOKEN_{index}', self.TWITTER_BEARER_TOKEN),
+                consumer_key=getenv(f'TWITTER_CUSTOMER_KEY_{index}'),
+                consumer_secret=getenv(f'TWITTER_CUSTOMER_SECRET_{index}'),
+                access_token=getenv(f'TWITTER_OAUTH_TOKEN_{index}'),
+                access_token_secret=getenv(f'TWITTER_OAUTH_SECRET_{index}')
+            ))
+            index += 1
+
+        return credentials
@@ -1,11 +1,116 @@
-from typing import Dict, List, TypedDict
+from typing import Dict, Iterable, List, Optional, Set, Tuple, Type, TypedDict
 from src import User, Config  # type: ignore
-from mongoengine import connect as mongo_connect, Document, IntField, StringField, ListField, QuerySet  # type: ignore
-from pymongo import MongoClient  # type: ignore
+from src.twitter import Account, Following
+from mongoengine import connect as mongo_connect, Document, IntField, LongField, StringField, ListField, DateTimeField, BinaryField, FloatField, BooleanField, DictField, QuerySet, Q  # type: ignore
+from datetime import datetime, timedelta
+from pytz import UTC  # type: ignore
+from pymongo import ASCENDING, MongoClient, ReturnDocument, UpdateOne  # type: ignore
+from pymongo.errors import BulkWriteError, OperationFailure  # type: ignore
+from bson import Binary, ObjectId  # type: ignore
+from array import array
+import numpy as np  # type: ignore
+import logging
+import zlib
+
+ID_FORMAT_RAW = 0
+ID_FORMAT_DELTA_ZLIB = 1
 
 
 def connect(config: Config) -> MongoClient:
-    return mongo_connect(config.MONGODB_DB_NAME, host=config.MONGODB_DB_HOST)
+    client = mongo_connect(config.MONGODB_DB_NAME,
+                           host=config.MONGODB_DB_HOST)
+    ensure_indexes()
+    ProfileDocument.set_ttl(config.PROFILE_CACHE_TTL)
+    return client
+
+
+def _remove_duplicates(document: Type[Document], field: str):
+    """Keep only the first inserted document of every duplicated field value
+
+    Args:
+        document (Type[Document]): Document class
+        field (str): Field that must be unique
+    """
+    collection = document._get_collection()
+
+    duplicates = collection.aggregate([
+        {"$sort": {"_id": 1}},
+        {"$group": {"_id": f"${field}", "ids": {
+            "$push": "$_id"}, "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}}
+    ], allowDiskUse=True)
+
+    for duplicate in duplicates:
+        logging.warning(
+            f"Removing {duplicate['count'] - 1} duplicated {document.__name__} with {field} {duplicate['_id']}")
+        collection.delete_many({"_id": {"$in": duplicate["ids"][1:]}})
+
+
+def ensure_indexes():
+    """Create declared indexes of every collection. Collections that got unique indexes
+    after they had data are deduplicated first
+    """
+    for document, field in [(Leaderboard, "username"), (UserDocument, "user_id")]:
+        try:
+            document.ensure_indexes()
+        except OperationFailure as e:
+            if e.code != 11000:
+                raise
+            _remove_duplicates(document, field)
+            document.ensure_indexes()
+
+    for document in [Configuration, ProfileDocument, FollowingCheckpoint, FollowEvent, PendingFollowing, OutboxRecord]:
+        document.ensure_indexes()
+
+
+def pack_ids(ids: Iterable[int], compress: bool = True) -> bytes:
+    """Pack user ids into sorted little endian int64 array. First byte is the format.
+    Compressed format stores the difference between consecutive ids before zlib,
+    which is much smaller than the ids themselves.
+
+    Args:
+        ids (Iterable[int]): User ids
+        compress (bool, optional): Delta encode and compress the array. Defaults to True.
+
+    Returns:
+        bytes: Packed ids
+    """
+    if isinstance(ids, array) and ids.typecode == 'q' and len(ids) > 0:
+        packed = np.unique(np.frombuffer(ids, dtype=np.int64))
+    else:
+        packed = np.unique(np.fromiter(ids, dtype=np.int64))
+
+    if compress:
+        payload = np.diff(packed, prepend=0).astype('<i8').tobytes()
+        return bytes([ID_FORMAT_DELTA_ZLIB]) + zlib.compress(payload)
+
+    return bytes([ID_FORMAT_RAW]) + packed.astype('<i8').tobytes()
+
+
+def unpack_ids(data: bytes) -> array:
+    """Unpack ids packed by pack_ids
+
+    Args:
+        data (bytes): Packed ids
+
+    Raises:
+        Exception: Unknown format
+
+    Returns:
+        array: Sorted user ids as int64 array
+    """
+    if not data:
+        return array('q')
+
+    if data[0] == ID_FORMAT_RAW:
+        unpacked = np.frombuffer(data, dtype='<i8', offset=1)
+    elif data[0] == ID_FORMAT_DELTA_ZLIB:
+        unpacked = np.cumsum(np.frombuffer(
+            zlib.decompress(data[1:]), dtype='<i8'))
+    else:
+        raise Exception('Unknown packed ids format')
+
+    return array('q', unpacked.astype(np.int64).tobytes())
 
 
 class UserPair(TypedDict):
@@ -17,27 +122,670 @@ class Configuration(Document):
     key = StringField(required=True)
     value = StringField(required=True)
 
+    meta = {
+        "indexes": ["key"]
+    }
+
 
 class Leaderboard(Document):
     username = StringField(required=True)
 
+    meta = {
+        "indexes": [{"fields": ["username"], "unique": True}],
+        # Created by ensure_indexes after duplicates are removed
+        "auto_create_index": False
+    }
+
+    @staticmethod
+    def admit(usernames: List[str]) -> Set[str]:
+        """Add usernames to leaderboard with one bulk upsert. The unique index decides
+        which usernames are new, so concurrent workers cannot admit the same user twice
+
+        Args:
+            usernames (List[str]): Candidate usernames
+
+        Returns:
+            Set[str]: Usernames that were not in leaderboard yet
+        """
+        if len(usernames) == 0:
+            return set()
+
+        # Own ids tell which upserts inserted a document
+        ids = {ObjectId(): username for username in dict.fromkeys(usernames)}
+
+        try:
+            upserted = Leaderboard._get_collection().bulk_write([UpdateOne(
+                {"username": username},
+                {"$setOnInsert": {"_id": id, "username": username}},
+                upsert=True
+            ) for id, username in ids.items()], ordered=False).upserted_ids.values()
+        except BulkWriteError as e:
+            # Losing a concurrent upsert race shows up as duplicate key error
+            if any(error["code"] != 11000 for error in e.details["writeErrors"]):
+                raise
+            upserted = [item["_id"] for item in e.details["upserted"]]
+
+        return {ids[id] for id in upserted if id in ids}
+
+
+class ProfileDocument(Document):
+    """Persisted profile cache of TwitterAPI.get_metrics, keyed by lowercase username
+    """
+    key = StringField(required=True, unique=True)
+    user_id = IntField()
+    username = StringField()
+    description = StringField(default="")
+    followers_count = IntField(default=0)
+    created_at = DateTimeField()
+    urls = ListField(StringField(), default=[])
+    fetched_at = DateTimeField(required=True)
+
+    meta = {
+        # Expired profiles are removed by MongoDB. Configured TTL is applied by set_ttl
+        "indexes": [{"fields": ["fetched_at"], "expireAfterSeconds": Config.PROFILE_CACHE_TTL}]
+    }
+
+    @staticmethod
+    def set_ttl(seconds: int):
+        """Set how long profiles are kept after they are fetched
+
+        Args:
+            seconds (int): Profile cache TTL in seconds
+        """
+        collection = ProfileDocument._get_collection()
+        collection.database.command("collMod", collection.name, index={
+            "keyPattern": {"fetched_at": 1},
+            "expireAfterSeconds": seconds
+        })
+
+    @staticmethod
+    def get_profiles(usernames: List[str], max_age: float) -> Dict[str, Tuple[float, Dict]]:
+        """Get profiles fetched less than max_age seconds ago
+
+        Args:
+            usernames (List[str]): Lowercase usernames
+            max_age (float): Maximum profile age in seconds
+
+        Returns:
+            Dict[str, Tuple[float, Dict]]: Lowercase username to fetch timestamp and profile metrics
+        """
+        profiles = ProfileDocument.objects(key__in=usernames, fetched_at__gte=datetime.utcnow(
+        ) - timedelta(seconds=max_age)).exclude("id").as_pymongo()
+
+        return {profile["key"]: (profile["fetched_at"].replace(tzinfo=UTC).timestamp(), {
+            "user_id": profile.get("user_id"),
+            "username": profile.get("username"),
+            "description": profile.get("description", ""),
+            "followers_count": profile.get("followers_count", 0),
+            "created_at": profile["created_at"].replace(tzinfo=UTC),
+            "urls": profile.get("urls", [])
+        }) for profile in profiles}
+
+    @staticmethod
+    def save_profiles(profiles: Dict[str, Dict]):
+        """Upsert profiles in one bulk write
+
+        Args:
+            profiles (Dict[str, Dict]): Username to profile metrics
+        """
+        if len(profiles) == 0:
+            return
+
+        now = datetime.utcnow()
+
+        ProfileDocument._get_collection().bulk_write([UpdateOne(
+            {"key": username.lower()},
+            {"$set": {
+                "user_id": profile["user_id"],
+                "username": profile["username"],
+                "description": profile["description"],
+                "followers_count": profile["followers_count"],
+                "created_at": profile["created_at"],
+                "urls": profile["urls"],
+                "fetched_at": now
+            }},
+            upsert=True
+        ) for username, profile in profiles.items()], ordered=False)
+
+
+class FollowingCheckpoint(Document):
+    """Pagination checkpoint of an unfinished User.get_following, one per tracked user
+    """
+    user_id = LongField(required=True, unique=True)
+    incremental = BooleanField(default=False)
+    pagination_token = StringField()
+    # Fetched accounts as [user_id, username, name]
+    accounts = ListField(ListField(), default=[])
+    updated_at = DateTimeField()
+
+    # Pagination token is only resumed for a day, older fetches restart
+    MAX_AGE = 24*60*60
+
+    @staticmethod
+    def load_checkpoint(user_id: int, incremental: bool) -> Optional[Tuple[str, List[Account]]]:
+        """Get checkpoint of unfinished fetch
+
+        Args:
+            user_id (int): Tracked user id
+            incremental (bool): Whether the fetch is incremental
+
+        Returns:
+            Optional[Tuple[str, List[Account]]]: Pagination token of next page and fetched accounts. None if there is no usable checkpoint
+        """
+        checkpoint = FollowingCheckpoint._get_collection().find_one({
+            "user_id": user_id,
+            "incremental": incremental,
+            "updated_at": {"$gte": datetime.utcnow() - timedelta(seconds=FollowingCheckpoint.MAX_AGE)}
+        })
+
+        if checkpoint is None or not checkpoint.get("pagination_token"):
+            return None
+
+        return checkpoint["pagination_token"], [Account(id, username, name) for id, username, name in checkpoint.get("accounts", [])]
+
+    @staticmethod
+    def save_checkpoint(user_id: int, incremental: bool, pagination_token: str, accounts: List[Account]):
+        """Append accounts of a completed page and save the token of the next page
+
+        Args:
+            user_id (int): Tracked user id
+            incremental (bool): Whether the fetch is incremental
+            pagination_token (str): Token of next page
+            accounts (List[Account]): Accounts of the completed page
+        """
+        FollowingCheckpoint._get_collection().update_one({"user_id": user_id}, {
+            "$set": {
+                "incremental": incremental,
+                "pagination_token": pagination_token,
+                "updated_at": datetime.utcnow()
+            },
+            "$push": {"accounts": {"$each": [[account.user_id, account.username, account.name] for account in accounts]}}
+        }, upsert=True)
+
+    @staticmethod
+    def clear_checkpoint(user_id: int):
+        """Delete checkpoint of finished or restarted fetch
+
+        Args:
+            user_id (int): Tracked user id
+        """
+        FollowingCheckpoint._get_collection().delete_one({"user_id": user_id})
+
+
+class FollowEvent(Document):
+    """Append only log of following changes observed by sync
+    """
+    FOLLOW = "follow"
+    UNFOLLOW = "unfollow"
+
+    tracker_id = LongField(required=True)
+    target_id = LongField(required=True)
+    kind = StringField(required=True, choices=(FOLLOW, UNFOLLOW))
+    observed_at = DateTimeField(required=True)
+    # UserDocument.version of the snapshot the diff was taken against
+    snapshot_version = IntField()
+
+    meta = {
+        "indexes": [
+            ("tracker_id", "-observed_at"),
+            ("target_id", "-observed_at"),
+            # A diff that is observed again because its snapshot was not saved is only logged once
+            {"fields": ["tracker_id", "target_id", "kind", "snapshot_version"], "unique": True,
+             "partialFilterExpression": {"snapshot_version": {"$exists": True}}}
+        ]
+    }
+
+    @staticmethod
+    def from_change(tracker_id: int, added: List[int], removed: List[int], observed_at: datetime, snapshot_version: int) -> List['FollowEvent']:
+        """Create events of one tracked user following diff
+
+        Args:
+            tracker_id (int): Tracked user id
+            added (List[int]): Followed ids
+            removed (List[int]): Unfollowed ids
+            observed_at (datetime): Time the diff was observed
+            snapshot_version (int): Version of the snapshot the diff was taken against
+
+        Returns:
+            List[FollowEvent]: Unsaved events
+        """
+        return [FollowEvent(tracker_id=tracker_id, target_id=target_id, kind=FollowEvent.FOLLOW, observed_at=observed_at, snapshot_version=snapshot_version) for target_id in added] + \
+            [FollowEvent(tracker_id=tracker_id, target_id=target_id, kind=FollowEvent.UNFOLLOW,
+                         observed_at=observed_at, snapshot_version=snapshot_version) for target_id in removed]
+
+    @staticmethod
+    def save_events(events: List['FollowEvent']):
+        """Insert events in one bulk insert. Events that are already logged for the same snapshot version are skipped
+
+        Args:
+            events (List[FollowEvent]): Events to insert
+        """
+        if len(events) == 0:
+            return
+
+        try:
+            FollowEvent._get_collection().insert_many(
+                [event.to_mongo() for event in events], ordered=False)
+        except BulkWriteError as e:
+            if any(error["code"] != 11000 for error in e.details["writeErrors"]):
+                raise
+
+    @staticmethod
+    def followed_since(target_id: int, since: datetime) -> QuerySet:
+        """Get follow events of an account since given time, newest first
+
+        Args:
+            target_id (int): Followed account id
+            since (datetime): Start time, inclusive
+
+        Returns:
+            QuerySet: Follow events
+        """
+        return FollowEvent.objects(target_id=target_id, kind=FollowEvent.FOLLOW, observed_at__gte=since).order_by("-observed_at")
+
+    @staticmethod
+    def tracker_activity(tracker_id: int, since: datetime, until: datetime = None) -> QuerySet:
+        """Get follow and unfollow events of a tracked user in a time range, newest first
+
+        Args:
+            tracker_id (int): Tracked user id
+            since (datetime): Start time, inclusive
+            until (datetime, optional): End time, exclusive. Defaults to None.
+
+        Returns:
+            QuerySet: Follow and unfollow events
+        """
+        if until is None:
+            return FollowEvent.objects(tracker_id=tracker_id, observed_at__gte=since).order_by("-observed_at")
+
+        return FollowEvent.objects(tracker_id=tracker_id, observed_at__gte=since, observed_at__lt=until).order_by("-observed_at")
+
+
+class PendingFollowing(Document):
+    """New following that was detected by sync and is not scored yet. Kept until scoring
+    succeeds, so detections survive a failed metrics lookup
+    """
+    # Tracked username, followed username and snapshot version, see FollowEvent.snapshot_version
+    key = StringField(required=True, unique=True)
+    tracked_user = StringField(required=True)
+    followed_user = StringField(required=True)
+    detected_at = DateTimeField(required=True)
+
+    meta = {
+        "indexes": ["detected_at"]
+    }
+
+    @staticmethod
+    def enqueue(following: List[Tuple[str, str, int]], detected_at: datetime):
+        """Store detected following in one insert. Following detected again against the same snapshot version is skipped
+
+        Args:
+            following (List[Tuple[str, str, int]]): Tracked username, followed username and snapshot version
+            detected_at (datetime): Detection time
+        """
+        if len(following) == 0:
+            return
+
+        try:
+            PendingFollowing._get_collection().insert_many([{
+                "key": f"{tracked_user}:{followed_user}:{version}",
+                "tracked_user": tracked_user,
+                "followed_user": followed_user,
+                "detected_at": detected_at
+            } for tracked_user, followed_user, version in following], ordered=False)
+        except BulkWriteError as e:
+            if any(error["code"] != 11000 for error in e.details["writeErrors"]):
+                raise
+
+    @staticmethod
+    def get_pending(limit: int) -> List[Dict]:
+        """Get oldest pending following
+
+        Args:
+            limit (int): Maximum number of following
+
+        Returns:
+            List[Dict]: Pending following with _id, tracked_user, followed_user and detected_at
+        """
+        return list(PendingFollowing._get_collection().find({}, {"tracked_user": True, "followed_user": True, "detected_at": True}).sort(
+            "detected_at", ASCENDING).limit(limit))
+
+    @staticmethod
+    def complete(ids: List[ObjectId]):
+        """Remove scored following
+
+        Args:
+            ids (List[ObjectId]): Pending following ids
+        """
+        if len(ids) == 0:
+            return
+
+        PendingFollowing._get_collection().delete_many({"_id": {"$in": ids}})
+
+
+class OutboxRecord(Document):
+    """Airtable record waiting to be sent by the outbox flusher. Key is the idempotency key
+    of the record, so enqueueing the same record twice only stores it once
+    """
+    key = StringField(required=True, unique=True)
+    table = StringField(required=True)
+    fields = DictField(required=True)
+    created_at = DateTimeField(required=True)
+    attempts = IntField(default=0)
+    next_attempt_at = DateTimeField(required=True)
+    last_error = StringField()
+    # Set when the record is parked after a rejection or too many attempts. Parked records
+    # are never claimed again, unset it to resend the record
+    failed_at = DateTimeField()
+    # Flusher that is sending the record, see claim
+    lease_owner = StringField()
+    lease_expires_at = DateTimeField()
+
+    meta = {
+        "indexes": [("table", "next_attempt_at")]
+    }
+
+    @staticmethod
+    def enqueue(table: str, records: Dict[str, Dict]):
+        """Store records to send to a table in one insert. Records whose key is already
+        in the outbox are skipped
+
+        Args:
+            table (str): Airtable table name
+            records (Dict[str, Dict]): Idempotency key to record fields
+        """
+        if len(records) == 0:
+            return
+
+        now = datetime.utcnow()
+
+        try:
+            OutboxRecord._get_collection().insert_many([{
+                "key": key,
+                "table": table,
+                "fields": fields,
+                "created_at": now,
+                "attempts": 0,
+                "next_attempt_at": now
+            } for key, fields in records.items()], ordered=False)
+        except BulkWriteError as e:
+            if any(error["code"] != 11000 for error in e.details["writeErrors"]):
+                raise
+
+    @staticmethod
+    def claim(table: str, owner: str, count: int, duration: timedelta) -> List[Dict]:
+        """Lease the oldest records of a table that are due for an attempt. Every record is claimed
+        with an atomic findAndModify, so concurrent flushers never send the same record
+
+        Args:
+            table (str): Airtable table name
+            owner (str): Flusher id
+            count (int): Maximum number of records
+            duration (timedelta): Lease duration
+
+        Returns:
+            List[Dict]: Claimed records with _id, key, fields and attempts
+        """
+        now = datetime.utcnow()
+        collection = OutboxRecord._get_collection()
+        records: List[Dict] = []
+
+        for _ in range(count):
+            record = collection.find_one_and_update({
+                "table": table,
+                "next_attempt_at": {"$lte": now},
+                "failed_at": None,
+                "$or": [{"lease_expires_at": None}, {"lease_expires_at": {"$lte": now}}]
+            }, {"$set": {
+                "lease_owner": owner,
+                "lease_expires_at": now + duration
+            }}, projection={"key": True, "fields": True, "attempts": True},
+                sort=[("created_at", ASCENDING)], return_document=ReturnDocument.AFTER)
+
+            if record is None:
+                break
+
+            records.append(record)
+
+        return records
+
+    @staticmethod
+    def complete(ids: List[ObjectId]):
+        """Remove sent records
+
+        Args:
+            ids (List[ObjectId]): Record ids
+        """
+        if len(ids) == 0:
+            return
+
+        OutboxRecord._get_collection().delete_many({"_id": {"$in": ids}})
+
+    @staticmethod
+    def reschedule(records: List[Dict], next_attempt_at: Dict[ObjectId, datetime], error: str):
+        """Release records of a failed attempt and set when they are tried again
+
+        Args:
+            records (List[Dict]): Claimed records
+            next_attempt_at (Dict[ObjectId, datetime]): Record id to next attempt time
+            error (str): Error of the failed attempt
+        """
+        if len(records) == 0:
+            return
+
+        OutboxRecord._get_collection().bulk_write([UpdateOne({"_id": record["_id"]}, {
+            "$set": {
+                "attempts": record.get("attempts", 0) + 1,
+                "next_attempt_at": next_attempt_at[record["_id"]],
+                "last_error": error
+            },
+            "$unset": {"lease_owner": "", "lease_expires_at": ""}
+        }) for record in records], ordered=False)
+
+    @staticmethod
+    def park(records: List[Dict], error: str):
+        """Release records that cannot be sent and stop claiming them
+
+        Args:
+            records (List[Dict]): Claimed records
+            error (str): Error of the last attempt
+        """
+        if len(records) == 0:
+            return
+
+        now = datetime.utcnow()
+
+        OutboxRecord._get_collection().bulk_write([UpdateOne({"_id": record["_id"]}, {
+            "$set": {
+                "attempts": record.get("attempts", 0) + 1,
+                "failed_at": now,
+                "last_error": error
+            },
+            "$unset": {"lease_owner": "", "lease_expires_at": ""}
+        }) for record in records], ordered=False)
+
 
 class UserDocument(Document):
     user_id = IntField(required=True)
     username = StringField(requried=True)
     name = StringField(default="")
-    following = ListField(default=[])
+    # Following snapshot is following_ids plus following_added minus following_removed.
+    # Changes only touch the delta arrays until they are compacted into following_ids
+    following_ids = BinaryField()
+    following_added = ListField(LongField(), default=[])
+    following_removed = ListField(LongField(), default=[])
+    # Nested User.to_dict snapshot used before following_ids. Migrated on next save
+    following = ListField()
+    full_synced_at = DateTimeField()
+    # Scheduling. Users that were never checked have no next_due_at and are picked first
+    last_checked_at = DateTimeField()
+    next_due_at = DateTimeField()
+    # Moving average of new following per hour
+    follow_rate = FloatField()
+    # Incremented by every saved check, see FollowEvent.snapshot_version
+    version = IntField(default=0)
+    # Consecutive failed checks, reset by a saved check
+    failures = IntField(default=0)
+    # Worker that is checking the user, see lease_pairs
+    lease_owner = StringField()
+    lease_expires_at = DateTimeField()
+
+    # Fields needed to diff and save following snapshot
+    SNAPSHOT_FIELDS = ("user_id", "username", "name", "following_ids",
+                       "following_added", "following_removed", "following", "full_synced_at")
+
+    # Fields needed to schedule the next check
+    SCHEDULE_FIELDS = ("last_checked_at", "next_due_at",
+                       "follow_rate", "version", "failures")
+
+    # Delta size that triggers a rewrite of following_ids
+    COMPACT_THRESHOLD = 1000
+
+    meta = {
+        "indexes": [
+            "username",
+            "next_due_at",
+            {"fields": ["user_id"], "unique": True}
+        ],
+        # Created by ensure_indexes after duplicates are removed
+        "auto_create_index": False
+    }
+
+    def get_following_ids(self) -> array:
+        """Get sorted ids of user following
+
+        Returns:
+            array: Following ids as int64 array
+        """
+        if self.following_ids is None and self.following:
+            base = array('q', sorted(user["user_id"]
+                         for user in self.following))
+        else:
+            base = unpack_ids(self.following_ids)
+
+        if len(self.following_added) == 0 and len(self.following_removed) == 0:
+            return base
+
+        ids = np.union1d(np.frombuffer(base, dtype=np.int64) if len(base) > 0 else np.empty(0, dtype=np.int64),
+                         np.array(self.following_added, dtype=np.int64))
+        ids = np.setdiff1d(ids, np.array(
+            self.following_removed, dtype=np.int64), assume_unique=True)
+
+        return array('q', ids.astype(np.int64).tobytes())
+
+    def set_following(self, following: Following):
+        """Replace following snapshot. Account names are not stored
+
+        Args:
+            following (Following): Following list
+        """
+        self.following_ids = pack_ids(following.ids)
+        self.following_added = []
+        self.following_removed = []
+        self.following = None
+
+    def get_following_updates(self, added: List[int], removed: List[int], following: Following, compact: bool = False) -> List[UpdateOne]:
+        """Build partial updates that apply a following diff to the stored snapshot. Diff goes to
+        the delta arrays, or the snapshot is rewritten when it is compacted
+
+        Args:
+            added (List[int]): Followed ids
+            removed (List[int]): Unfollowed ids
+            following (Following): Complete following list after the diff
+            compact (bool, optional): Rewrite following_ids and clear the deltas. Defaults to False.
+
+        Returns:
+            List[UpdateOne]: Updates for UserDocument collection bulk_write
+        """
+        delta = len(self.following_added) + \
+            len(self.following_removed) + len(added) + len(removed)
+
+        if compact or self.following_ids is None or delta > self.COMPACT_THRESHOLD:
+            return [UpdateOne({"_id": self.pk}, {
+                "$set": {
+                    "following_ids": Binary(pack_ids(following.ids)),
+                    "following_added": [],
+                    "following_removed": [],
+                    "full_synced_at": self.full_synced_at
+                },
+                "$unset": {"following": ""}
+            })]
+
+        # A field cannot be added to and pulled from in the same update
+        updates: List[UpdateOne] = []
+
+        if len(added) != 0:
+            updates.append(UpdateOne({"_id": self.pk}, {
+                "$addToSet": {"following_added": {"$each": added}},
+                "$pull": {"following_removed": {"$in": added}}
+            }))
+
+        if len(removed) != 0:
+            updates.append(UpdateOne({"_id": self.pk}, {
+                "$addToSet": {"following_removed": {"$each": removed}},
+                "$pull": {"following_added": {"$in": removed}}
+            }))
+
+        return updates
+
+    def get_schedule_update(self, checked_at: datetime, next_due_at: datetime, follow_rate: Optional[float] = None) -> UpdateOne:
+        """Build partial update that records a check and when the user is due again
+
+        Args:
+            checked_at (datetime): Check time
+            next_due_at (datetime): Latest next check time
+            follow_rate (Optional[float], optional): New following per hour. Defaults to None, which keeps the stored rate.
+
+        Returns:
+            UpdateOne: Update for UserDocument collection bulk_write
+        """
+        self.last_checked_at = checked_at
+        self.next_due_at = next_due_at
+        self.failures = 0
+        update = {"last_checked_at": checked_at,
+                  "next_due_at": next_due_at, "failures": 0}
+
+        if follow_rate is not None:
+            self.follow_rate = follow_rate
+            update["follow_rate"] = follow_rate
+
+        self.version = (self.version or 0) + 1
+
+        return UpdateOne({"_id": self.pk}, {"$set": update, "$inc": {"version": 1}})
+
+    def get_failure_update(self, next_due_at: datetime) -> UpdateOne:
+        """Build partial update that records a failed check and postpones the next one
+
+        Args:
+            next_due_at (datetime): Next check time
+
+        Returns:
+            UpdateOne: Update for UserDocument collection bulk_write
+        """
+        self.next_due_at = next_due_at
+        self.failures = (self.failures or 0) + 1
+
+        return UpdateOne({"_id": self.pk}, {"$set": {"next_due_at": next_due_at}, "$inc": {"failures": 1}})
+
+    @staticmethod
+    def bulk_update(updates: List[UpdateOne]):
+        """Send following and schedule updates of checked users in one bulk write
 
-    def to_dict(self) -> Dict:
-        return {
-            "user_id": self.user_id,
-            "username": self.username,
-            "name": self.name,
-            "following": self.following
-        }
+        Args:
+            updates (List[UpdateOne]): Updates built by get_following_updates and get_schedule_update
+        """
+        if len(updates) == 0:
+            return
+
+        UserDocument._get_collection().bulk_write(updates, ordered=True)
 
     def to_user_class(self) -> User:
-        return User.from_dict(self.to_dict())
+        """Convert to user class. Following names are not stored, so only ids are loaded
+
+        Returns:
+            User: Twitter user
+        """
+        return User(self.user_id, self.username, self.name, following=Following(self.get_following_ids()))
 
     @classmethod
     def create_from_user_class(cls, user: User):
@@ -49,34 +797,113 @@ class UserDocument(Document):
         Returns:
             User: Saved user document
         """
-        return cls(**user.to_dict()).save()
+        document = cls(user_id=user.user_id, username=user.username,
+                       name=user.name, full_synced_at=datetime.utcnow())
+        document.set_following(user.following)
+
+        return document.save()
 
     @staticmethod
-    def users_from_query_set(users: QuerySet) -> List[UserPair]:
-        """Convert user documents to list of User class
+    def lease_pairs(owner: str, duration: timedelta, count: int, due_at: Optional[datetime] = None, usernames: Optional[List[str]] = None) -> List[UserPair]:
+        """Lease users to one worker. Every user is claimed with an atomic findAndModify, so
+        concurrent workers never get the same user. Users leased by another worker are skipped
+        until the lease expires. Most overdue users are leased first and users without
+        next_due_at sort first, so new users are checked on the next run
 
         Args:
-            users (QuerySet): Users query set
+            owner (str): Worker id
+            duration (timedelta): Lease duration
+            count (int): Maximum number of users
+            due_at (Optional[datetime], optional): Only lease users due at this time. Defaults to None, which leases users that are not due yet too.
+            usernames (Optional[List[str]], optional): Only lease these users. Defaults to None.
 
         Returns:
-            List[User]: List of twitter user
+            List[UserPair]: Leased user and its document, most overdue first
         """
-        result: List[UserPair] = []
+        now = datetime.utcnow()
+        query: List[Dict] = [{"$or": [{"lease_expires_at": None}, {
+            "lease_expires_at": {"$lte": now}}]}]
+
+        if due_at is not None:
+            query.append({"$or": [{"next_due_at": None}, {
+                         "next_due_at": {"$lte": due_at}}]})
 
-        for user in users:
-            if isinstance(user, UserDocument):
-                result.append({"user": user.to_user_class(), "document": user})
+        if usernames is not None:
+            query.append({"username": {"$in": usernames}})
 
-        return result
+        collection = UserDocument._get_collection()
+        projection = {field: True for field in UserDocument.SNAPSHOT_FIELDS +
+                      UserDocument.SCHEDULE_FIELDS}
+        pairs: List[UserPair] = []
+
+        for _ in range(count):
+            son = collection.find_one_and_update({"$and": query}, {"$set": {
+                "lease_owner": owner,
+                "lease_expires_at": now + duration
+            }}, projection=projection, sort=[("next_due_at", ASCENDING)], return_document=ReturnDocument.AFTER)
+
+            if son is None:
+                break
+
+            document: UserDocument = UserDocument._from_son(son)
+            pairs.append(UserPair(user=document.to_user_class(), document=document))
+
+        return pairs
 
     @staticmethod
-    def get_usernames(users: QuerySet) -> List[str]:
-        """Convert user documents to list of usernames
+    def extend_leases(owner: str, ids: List[ObjectId], duration: timedelta) -> int:
+        """Extend leases that are still held by owner. Leases taken by another worker are kept
 
         Args:
-            users (QuerySet): Users query set
+            owner (str): Worker id
+            ids (List[ObjectId]): Document ids
+            duration (timedelta): Lease duration from now
+
+        Returns:
+            int: Number of extended leases
+        """
+        if len(ids) == 0:
+            return 0
+
+        return UserDocument._get_collection().update_many({"_id": {"$in": ids}, "lease_owner": owner}, {
+            "$set": {"lease_expires_at": datetime.utcnow() + duration}
+        }).matched_count
+
+    @staticmethod
+    def release_leases(owner: str, ids: List[ObjectId]):
+        """Release leases of users so other workers can check them. Leases that expired and
+        were taken by another worker are kept
+
+        Args:
+            owner (str): Worker id
+            ids (List[ObjectId]): Document ids
+        """
+        if len(ids) == 0:
+            return
+
+        UserDocument._get_collection().update_many({"_id": {"$in": ids}, "lease_owner": owner}, {
+            "$unset": {"lease_owner": "", "lease_expires_at": ""}
+        })
+
+    @staticmethod
+    def get_schedules(not_due_at: datetime) -> List[Tuple[str, Optional[datetime], Optional[float]]]:
+        """Get schedule of users that are not due yet and not leased, without loading the following snapshots.
+        Users whose last check failed are left out, they are only checked again when they are due
+
+        Args:
+            not_due_at (datetime): Time the users are not due at
+
+        Returns:
+            List[Tuple[str, Optional[datetime], Optional[float]]]: Username, last check time and follow rate
+        """
+        return list(UserDocument.objects(Q(next_due_at__gt=not_due_at) & (Q(lease_expires_at=None) | Q(lease_expires_at__lte=not_due_at)) & (Q(failures=None) | Q(failures=0))).scalar(
+            "username", "last_checked_at", "follow_rate"))
+
+    @staticmethod
+    def get_all_usernames() -> List[str]:
+        """Get username of every tracked user without loading the documents
 
         Returns:
             List[str]: List of Twitter usernames
         """
-        return [user.username for user in users]
+        return list(UserDocument.objects.scalar("username"))
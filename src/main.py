@@ -1,11 +1,25 @@
-from typing import Dict, List, TypedDict
+from typing import Dict, List, Optional, Tuple, TypedDict
+from bson import ObjectId  # type: ignore
+from mongoengine.errors import NotUniqueError  # type: ignore
 from mongoengine.queryset.queryset import QuerySet  # type: ignore
-from src import User, Config, UserDocument, UserPair, Scorer, TwitterAPI, Configuration, Airtable, NewFollowing  # type: ignore
-from datetime import date, datetime
-from random import sample
+from tweepy.errors import HTTPException  # type: ignore
+from src import User, Config, UserDocument, ProfileDocument, FollowingCheckpoint, FollowEvent, PendingFollowing, UserPair, Scorer, TwitterAPI, Configuration, Airtable, NewFollowing  # type: ignore
+from src.retry import classify
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event, Thread
+from datetime import date, datetime, timedelta
+from math import ceil, exp
 import logging
 import random
 
+TIMELINE = "TIMELINE"
+
+# Time constant in seconds of the follow rate moving average
+FOLLOW_RATE_WINDOW = 7*24*60*60
+
+# Pending following scored per sync
+PENDING_BATCH_SIZE = 1000
+
 
 def format_message(user: str, following_changes: List[str]) -> str:
     today = date.today().strftime('%m/%d/%Y')
@@ -23,6 +37,12 @@ class Progress(TypedDict):
     users: List[UserPair]
 
 
+class FollowingChange(TypedDict):
+    added: List[int]
+    removed: List[int]
+    full_sync: bool
+
+
 class App:
     twitter_api: TwitterAPI
     airtable: Airtable
@@ -30,83 +50,145 @@ class App:
     users: List[UserPair]
     scorer: Scorer
     keywords: List[Dict]
+    bootstrap: Optional[Thread]
 
     def __init__(self, config: Config):
         self.config = config
-        self.twitter_api = TwitterAPI(config)
+        self.bootstrap = None
+        self.twitter_api = TwitterAPI(
+            config, ProfileDocument if config.PROFILE_CACHE_PERSIST else None)
         self.airtable = Airtable(config)
         self.keywords = self.airtable.get_keywords()
 
         self.config.WATCHED_USERS.extend(
             [data["Tracked Users"] for data in self.airtable.get_tracked_users()])
         self.scorer = Scorer(self.keywords,
-                             self.airtable.get_tracked_users())
+                             self.airtable.get_tracked_users(), config.SCORE_CACHE_SIZE)
 
     def _initialize(self):
-        """Initialize the application setup
+        """Initialize the application setup. New users are added by a background job,
+        so sync can serve the users that are already added in the meantime
         """
         to_sync = self._get_to_sync_users(
-            self.config.WATCHED_USERS, UserDocument.get_usernames(UserDocument.objects.only("username").select_related()))
+            self.config.WATCHED_USERS, UserDocument.get_all_usernames())
 
         self._delete_users(to_sync["to_delete"])
-        self._add_users(to_sync["to_add"])
+        self._start_bootstrap(to_sync["to_add"])
+        self.airtable.start_flusher(self.config.WORKER_ID)
+
+        # Check progress is kept per user by next_due_at
+        Configuration.objects(key="PROGRESS").delete()
+
+    def _get_revisit_interval(self) -> timedelta:
+        """Get longest time between checks of a user. It is REVISIT_INTERVAL, unless the users cannot
+        all be checked in it when SYNC_COUNT users are checked every SYNC_INTERVAL
+
+        Returns:
+            timedelta: Revisit interval
+        """
+        cycles = max(ceil(UserDocument.objects.count() /
+                          max(self.config.SYNC_COUNT, 1)), 1)
+
+        return timedelta(seconds=max(cycles * self.config.SYNC_INTERVAL, self.config.REVISIT_INTERVAL))
+
+    def _get_expected_following(self, last_checked_at: Optional[datetime], follow_rate: Optional[float], now: datetime) -> float:
+        """Estimate new following of a user since its last check
+
+        Args:
+            last_checked_at (Optional[datetime]): Last check time
+            follow_rate (Optional[float]): New following per hour
+            now (datetime): Current time
+
+        Returns:
+            float: Expected new following
+        """
+        if last_checked_at is None or follow_rate is None:
+            return 0.0
+
+        return follow_rate * max((now - last_checked_at).total_seconds(), 0) / 3600
+
+    def _get_follow_rate(self, document: UserDocument, added: int, checked_at: datetime) -> Optional[float]:
+        """Update moving average of new following per hour with the following found by a check.
+        Older observations decay with FOLLOW_RATE_WINDOW time constant
+
+        Args:
+            document (UserDocument): User document before the check is saved
+            added (int): New following found by the check
+            checked_at (datetime): Check time
 
-    def _get_check_progress(self) -> List[str]:
-        progress: QuerySet = Configuration.objects(key="PROGRESS")
-        if progress.count() == 0:
-            Configuration(key="PROGRESS", value="").save()
-            return []
-        elif progress.count() == 1:
-            value: str = progress.first().value
-            if value == "":
-                return []
-            return value.split(',')
-        else:
-            raise Exception('Cannot get progress')
+        Returns:
+            Optional[float]: New following per hour. None if the user was never checked before
+        """
+        if document.last_checked_at is None:
+            return document.follow_rate
 
-    def _get_user_pair_from_list(self, usernames: List[str]) -> List[UserPair]:
-        result: List[UserPair] = []
+        elapsed = (checked_at - document.last_checked_at).total_seconds()
 
-        for user in usernames:
-            user_document: UserDocument = UserDocument.objects(
-                username=user).first()
+        if elapsed <= 0:
+            return document.follow_rate
 
-            result.append(
-                UserPair(user=user_document.to_user_class(), document=user_document))
+        rate = added * 3600 / elapsed
 
-        return result
+        if document.follow_rate is None:
+            return rate
 
-    def _add_usernames_to_saved_progress(self, usernames: List[str]):
-        old_progress = self._get_check_progress()
-        old_progress.extend(usernames)
+        weight = 1 - exp(-elapsed / FOLLOW_RATE_WINDOW)
 
-        progress: Configuration = Configuration.objects(key="PROGRESS").first()
-        progress.value = ','.join(old_progress)
-        progress.save()
+        return document.follow_rate + weight * (rate - document.follow_rate)
 
     def _get_users_to_check(self) -> Progress:
-        usernames = UserDocument.get_usernames(
-            UserDocument.objects.only("username").select_related())
-        progress = self._get_check_progress()
-
-        to_check = list(set(usernames) - set(progress))
-
-        if len(to_check) == 0:
-            document: Configuration = Configuration.objects(
-                key='PROGRESS').first()
-            document.value = ""
-            document.save()
-
-            if len(usernames) < self.config.SYNC_COUNT:
-                return Progress(list=usernames, users=self._get_user_pair_from_list(usernames))
-            else:
-                samples = sample(usernames, self.config.SYNC_COUNT)
-                return Progress(list=samples, users=self._get_user_pair_from_list(samples))
-        elif len(to_check) > self.config.SYNC_COUNT:
-            samples = sample(to_check, self.config.SYNC_COUNT)
-            return Progress(list=samples, users=self._get_user_pair_from_list(samples))
-        else:
-            return Progress(list=to_check, users=self._get_user_pair_from_list(to_check))
+        """Pick SYNC_COUNT users to check. Users past their next_due_at are picked first, so every
+        user is checked within the revisit interval. The rest of the budget goes to users with the
+        most expected new following since their last check
+
+        Users are leased to this worker, so other workers check different users.
+        Leases must be released with UserDocument.release_leases after the check
+
+        Returns:
+            Progress: Users to check
+        """
+        now = datetime.utcnow()
+        duration = timedelta(seconds=self.config.LEASE_DURATION)
+        users = UserDocument.lease_pairs(
+            self.config.WORKER_ID, duration, self.config.SYNC_COUNT, due_at=now)
+        remaining = self.config.SYNC_COUNT - len(users)
+
+        try:
+            if remaining > 0:
+                schedules = UserDocument.get_schedules(now)
+                schedules.sort(key=lambda schedule: (
+                    -self._get_expected_following(schedule[1], schedule[2], now), schedule[1] or datetime.min))
+                # Users leased by another worker in the meantime are skipped
+                users.extend(UserDocument.lease_pairs(self.config.WORKER_ID, duration, remaining, usernames=[
+                    username for username, _, _ in schedules[:remaining]]))
+        except Exception:
+            UserDocument.release_leases(self.config.WORKER_ID, [
+                                        user["document"].pk for user in users])
+            raise
+
+        return Progress(list=[user["user"].username for user in users], users=users)
+
+    def _renew_leases(self, ids: List[ObjectId], stop: Event):
+        """Extend leases of the users of a running check every third of LEASE_DURATION, so a check
+        that waits for rate limit windows keeps its users until it ends
+
+        Args:
+            ids (List[ObjectId]): Document ids of leased users
+            stop (Event): Set when the check ends
+        """
+        duration = timedelta(seconds=self.config.LEASE_DURATION)
+
+        while not stop.wait(self.config.LEASE_DURATION / 3):
+            try:
+                renewed = UserDocument.extend_leases(
+                    self.config.WORKER_ID, ids, duration)
+            except Exception:
+                logging.exception("Failed to renew leases")
+                continue
+
+            if renewed < len(ids):
+                logging.warning(
+                    f"Lost lease of {len(ids) - renewed} users to another worker")
 
     def _get_to_sync_users(self, new: List[str], old: List[str]) -> Dict:
         """Compare old and new username list
@@ -138,117 +220,281 @@ class App:
         users: QuerySet = UserDocument.objects(username__in=usernames)
         users.delete()
 
+    def _start_bootstrap(self, usernames: List[str]):
+        """Add users in a background thread. Users that failed are added again by _resume_bootstrap,
+        and their following fetch continues from its checkpoint
+
+        Args:
+            usernames (List[str]): Usernames to add
+        """
+        if len(usernames) == 0 or (self.bootstrap is not None and self.bootstrap.is_alive()):
+            return
+
+        self.bootstrap = Thread(target=self._add_users, args=(
+            usernames,), name="bootstrap", daemon=True)
+        self.bootstrap.start()
+
+    def _resume_bootstrap(self):
+        """Start bootstrap again for watched users that are still not added, once the previous bootstrap has finished
+        """
+        if self.bootstrap is not None and self.bootstrap.is_alive():
+            return
+
+        added = {username.lower()
+                 for username in UserDocument.get_all_usernames()}
+        missing = [username for username in self.config.WATCHED_USERS
+                   if username.lower() not in added]
+
+        if len(missing) != 0:
+            logging.info(
+                f"Retrying to add {', '.join(missing)}")
+            self._start_bootstrap(missing)
+
+    def _add_user(self, user: User):
+        """Fetch following of new user and save it. Runs inside bootstrap worker thread
+
+        Args:
+            user (User): User to add
+        """
+        logging.info(f"Adding {user.username} ...")
+
+        try:
+            user.get_following(self.twitter_api.pool.get_client(
+                share=self.config.BOOTSTRAP_RATE_SHARE), checkpoint=FollowingCheckpoint)
+            UserDocument.create_from_user_class(user)
+        except NotUniqueError:
+            logging.info(f"{user.username} is already added by another worker")
+        except Exception:
+            logging.exception(f"Failed to add {user.username}")
+            return
+
+        logging.info(f"Added {user.username}")
+
     def _add_users(self, usernames: List[str]):
-        """Add user from database
+        """Add user from database. Following of BOOTSTRAP_CONCURRENCY users is fetched at once with
+        BOOTSTRAP_RATE_SHARE of the rate limit, the rest is left for sync. Every user is saved as soon as it is fetched
 
         Args:
-            usernames (List[str]): [description]
+            usernames (List[str]): Usernames to add
         """
         if len(usernames) == 0:
             return
 
-        users: List[User] = self.twitter_api.get_users(usernames)
+        try:
+            users: List[User] = self.twitter_api.get_users(
+                usernames, self.twitter_api.pool.get_client(share=self.config.BOOTSTRAP_RATE_SHARE))
+        except Exception:
+            logging.exception("Failed to get users to add")
+            return
+
+        # Users can be added by another worker since the watched list was compared
+        added = set(UserDocument.objects(
+            user_id__in=[int(user.user_id) for user in users]).scalar("user_id"))
+        users = [user for user in users if int(user.user_id) not in added]
 
         logging.info('Adding users to track ...')
 
-        for user in users:
-            logging.info(f"Adding {user.username} ...")
-            user.get_following(self.twitter_api.client)
-            UserDocument.create_from_user_class(user)
+        with ThreadPoolExecutor(max_workers=self.config.BOOTSTRAP_CONCURRENCY) as executor:
+            list(executor.map(self._add_user, users))
 
         logging.info('Completed adding users')
 
-    def _notify_new_following(self, user: User, usernames: List[str]):
-        if len(usernames) == 0:
-            return
+    def _get_following_data(self, following: List[Tuple[str, str, datetime]]) -> List[NewFollowing]:
+        """Score new following. Metrics of the deduplicated followed users are resolved in one get_metrics call
+
+        Args:
+            following (List[Tuple[str, str, datetime]]): Tracked user and followed user usernames with detection time
+
+        Returns:
+            List[NewFollowing]: Scored following. Followed users without metrics are skipped
+        """
+        metrics = self.twitter_api.get_metrics(
+            list(dict.fromkeys(username for _, username, _ in following)))
 
-        metrics = self.twitter_api.get_metrics(usernames)
-        today = datetime.now()
+        for _, username, _ in following:
+            if username not in metrics:
+                logging.warning(f"Cannot get metrics of {username}. Skipping")
+
+        usernames = [username for username in dict.fromkeys(
+            username for _, username, _ in following) if username in metrics]
+        index = {username: i for i, username in enumerate(usernames)}
+        scores = self.scorer.score_batch(
+            [metrics[username] for username in usernames])
 
         following_data: List[NewFollowing] = []
 
-        for username in usernames:
-            created_at: datetime = metrics[username]['created_at']
-            followers_count: int = metrics[username]['followers_count']
-            url_points, urls = self.scorer.get_url_point(
-                metrics[username]["urls"])
+        for tracked_user, username, followed_at in following:
+            if username not in index:
+                continue
+
+            i = index[username]
 
             following_data.append(NewFollowing(
-                tracked_user=user.username,
-                tracked_user_points=self.scorer.get_username_point(
-                    user.username),
+                tracked_user=tracked_user,
+                tracked_user_points=0 if tracked_user == TIMELINE else self.scorer.get_username_point(
+                    tracked_user),
                 followed_user=username,
-                followed_at=today,
-                created_at=created_at,
-                created_at_points=self.scorer.get_timedelta_point(created_at),
-                followers_count=followers_count,
-                followers_count_points=self.scorer.get_followers_point(
-                    followers_count),
+                followed_at=followed_at,
+                created_at=metrics[username]['created_at'],
+                created_at_points=int(scores["created_at_points"][i]),
+                followers_count=metrics[username]['followers_count'],
+                followers_count_points=int(
+                    scores["followers_count_points"][i]),
                 description=metrics[username]["description"],
-                description_points=self.scorer.get_keyword_point(
-                    metrics[username]["description"]),
-                urls=urls,
-                url_points=url_points
+                description_points=int(scores["description_points"][i]),
+                urls=scores["urls"][i],
+                url_points=int(scores["url_points"][i])
             ))
 
+        return following_data
+
+    def _notify_new_following(self, following: List[Tuple[str, str, datetime]]):
+        """Score new following of the whole sync cycle and store them in the Airtable outbox in one batch per sink
+
+        Args:
+            following (List[Tuple[str, str, datetime]]): Tracked user and followed user usernames with detection time
+        """
+        if len(following) == 0:
+            return
+
+        following_data = self._get_following_data(following)
+
+        cache_info = self.scorer.cache_info()
+        logging.info(
+            f"Score cache: {cache_info['hits']} hits, {cache_info['misses']} misses, {cache_info['size']} entries")
+
         if len(following_data) > 0:
-            self.airtable.save_leaderboard(following_data)
-            self.airtable.save_raw(following_data)
+            self.airtable.enqueue_following(following_data)
 
-    def _notify_new_following_from_timeline(self, users: List[Dict]):
-        if len(users) == 0:
+    def _notify_pending_following(self):
+        """Score pending following and store them in the Airtable outbox. On failure they stay
+        pending and are scored by a later sync
+        """
+        pending = PendingFollowing.get_pending(PENDING_BATCH_SIZE)
+
+        if len(pending) == 0:
             return
 
-        metrics = self.twitter_api.get_metrics(
-            [user["username"] for user in users])
-        today = datetime.now()
+        try:
+            self._notify_new_following(
+                [(item["tracked_user"], item["followed_user"], item["detected_at"]) for item in pending])
+        except Exception:
+            logging.exception(
+                f"Failed to score {len(pending)} new following. Retrying next run")
+            return
 
-        following_data: List[NewFollowing] = []
+        PendingFollowing.complete([item["_id"] for item in pending])
 
-        for user in users:
-            username = user["username"]
-            created_at: datetime = metrics[username]['created_at']
-            followers_count: int = metrics[username]['followers_count']
-            url_points, urls = self.scorer.get_url_point(
-                metrics[username]["urls"])
+    def _notify_new_following_from_timeline(self, users: List[Dict]):
+        if len(users) == 0:
+            return
 
-            following_data.append(NewFollowing(
-                tracked_user="TIMELINE",
-                tracked_user_points=0,
-                followed_user=username,
-                followed_at=today,
-                created_at=created_at,
-                created_at_points=self.scorer.get_timedelta_point(created_at),
-                followers_count=followers_count,
-                followers_count_points=self.scorer.get_followers_point(
-                    followers_count),
-                description=metrics[username]["description"],
-                description_points=self.scorer.get_keyword_point(
-                    metrics[username]["description"]),
-                urls=urls,
-                url_points=url_points
-            ))
+        following_data = self._get_following_data(
+            [(TIMELINE, user["username"], datetime.utcnow()) for user in users])
 
         if len(following_data) > 0:
-            self.airtable.save_leaderboard(following_data)
-            self.airtable.save_raw(following_data)
+            self.airtable.enqueue_following(following_data)
             logging.info(
                 f"Added {len(following_data)} users from tweet search")
 
-    def _notify_new_unfollowing(self, user: User, usernames: List[str]):
-        if len(usernames) == 0:
+    def _notify_new_unfollowing(self, user: User, ids: List[int]):
+        if len(ids) == 0:
             return
         pass
 
-    def _save_from_users(self, users: List[UserPair]):
-        """Persist following data to user
+    def _get_failure_backoff(self, failures: int) -> timedelta:
+        """Get delay before a user whose checks keep failing is checked again. It doubles every
+        failure from SYNC_INTERVAL up to the revisit interval, so a protected, suspended or deleted
+        account does not take a check of every run
+
+        Args:
+            failures (int): Consecutive failed checks so far
+
+        Returns:
+            timedelta: Delay before the next check
+        """
+        return min(timedelta(seconds=self.config.SYNC_INTERVAL * 2 ** min(failures, 16)), self._get_revisit_interval())
+
+    def _save_from_users(self, users: List[UserPair], changes: List[FollowingChange], checked_at: datetime, failed: Optional[List[UserPair]] = None):
+        """Persist following changes and next check time of users as partial updates in one bulk write
+
+        Args:
+            users (List[UserPair]): Checked users
+            changes (List[FollowingChange]): Following change of each user
+            checked_at (datetime): Check time
+            failed (List[UserPair], optional): Users whose check failed. They are postponed with backoff. Defaults to None.
+        """
+        updates = []
+
+        for pair, change in zip(users, changes):
+            if pair["user"].changed:
+                updates.extend(pair["document"].get_following_updates(
+                    change["added"], change["removed"], pair["user"].following, compact=change["full_sync"]))
+                pair["user"].set_unchanged()
+
+        next_due_at = checked_at + self._get_revisit_interval()
+        updates.extend(pair["document"].get_schedule_update(
+            checked_at, next_due_at, self._get_follow_rate(pair["document"], len(change["added"]), checked_at)) for pair, change in zip(users, changes))
+        updates.extend(pair["document"].get_failure_update(
+            checked_at + self._get_failure_backoff(pair["document"].failures or 0)) for pair in failed or [])
+
+        UserDocument.bulk_update(updates)
+
+    def _is_full_sync_due(self, document: UserDocument) -> bool:
+        """Check whether user following should be fully refetched to catch unfollowing
+
+        Args:
+            document (UserDocument): User document
+
+        Returns:
+            bool: True if last full fetch is older than FULL_SYNC_INTERVAL
+        """
+        if document.full_synced_at is None:
+            return True
+
+        return (datetime.utcnow() - document.full_synced_at).total_seconds() >= self.config.FULL_SYNC_INTERVAL
+
+    def _fetch_following(self, pair: UserPair) -> FollowingChange:
+        """Refetch user following. Runs inside sync worker thread so it only talks to Twitter
+        and the pagination checkpoint of the user
+
+        Args:
+            pair (UserPair): User to refetch
+
+        Returns:
+            FollowingChange: new following and new unfollowing ids
+        """
+        user = pair["user"]
+        full_sync = self._is_full_sync_due(pair["document"])
+        old = user.following
+        user.get_following(self.twitter_api.pool.get_client(),
+                           incremental=not full_sync, checkpoint=FollowingCheckpoint)
+
+        if full_sync:
+            pair["document"].full_synced_at = datetime.utcnow()
+            user.set_changed()
+
+        added, removed = user.following.diff(old)
+
+        return FollowingChange(added=added, removed=removed, full_sync=full_sync)
+
+    def _try_fetch_following(self, pair: UserPair) -> Tuple[Optional[FollowingChange], bool]:
+        """Refetch user following. Failure is logged, so the other users of the cycle are still saved
+
+        Args:
+            pair (UserPair): User to refetch
+
+        Returns:
+            Tuple[Optional[FollowingChange], bool]: new following and new unfollowing ids, None if fetch failed.
+                And whether Twitter refused the account itself, e.g. protected, suspended or deleted
         """
-        for user in users:
-            if user["user"].changed:
-                user["document"].following = [user.to_dict()
-                                              for user in user["user"].following]
-                user["user"].set_unchanged()
-                user["document"].save()
+        try:
+            return self._fetch_following(pair), False
+        except Exception as e:
+            logging.exception(
+                f"Failed to fetch following of {pair['user'].username}")
+            # Outages, open circuits and exhausted retries leave the user due for the next run
+            return None, isinstance(e, HTTPException) and not classify(e)[0]
 
     def sync(self):
         """Monitor new following and unfollowing then notify to user
@@ -258,24 +504,53 @@ class App:
         #     self.keywords, 6 if len(self.keywords) > 6 else len(self.keywords))])
         # self._notify_new_following_from_timeline(users_timeline)
 
-        progress: Progress = self._get_users_to_check()
-        logging.info("Checking {}".format(', '.join(progress["list"])))
+        self._resume_bootstrap()
+
+        progress = Progress(list=[], users=[])
+        stop = Event()
+
+        try:
+            progress = self._get_users_to_check()
+            Thread(target=self._renew_leases, args=([user["document"].pk for user in progress["users"]], stop),
+                   daemon=True).start()
+
+            logging.info("Checking {}".format(', '.join(progress["list"])))
+
+            with ThreadPoolExecutor(max_workers=self.config.SYNC_CONCURRENCY) as executor:
+                results = list(executor.map(
+                    self._try_fetch_following, progress["users"]))
+
+            fetched = [(pair, change) for pair, (change, _) in zip(
+                progress["users"], results) if change is not None]
+            failed = [pair for pair, (_, refused) in zip(
+                progress["users"], results) if refused]
+            users = [pair for pair, _ in fetched]
+            changes = [change for _, change in fetched]
+
+            following: List[Tuple[str, str, int]] = []
+            events: List[FollowEvent] = []
+            observed_at = datetime.utcnow()
 
-        client = self.twitter_api.get_new_client()
+            for pair, change in fetched:
+                user = pair["user"]
 
-        for pair in progress["users"]:
-            user = pair["user"]
-            old = user.following_usernames.copy()
-            user.get_following(client)
-            new = user.following_usernames.copy()
+                if len(change["added"]) != 0 or len(change["removed"]) != 0:
+                    user.set_changed()
+                    version = pair["document"].version or 0
+                    following.extend((user.username, username, version)
+                                     for username in user.following.usernames(change["added"]))
+                    events.extend(FollowEvent.from_change(
+                        user.user_id, change["added"], change["removed"], observed_at, version))
+                    self._notify_new_unfollowing(user, change["removed"])
 
-            new_following = User.new_following(new, old)
-            new_unfollowing = User.new_unfollowing(new, old)
+            # Detections are stored before the snapshot, both are idempotent per snapshot version
+            FollowEvent.save_events(events)
+            PendingFollowing.enqueue(following, observed_at)
 
-            if len(new_following) != 0 or len(new_unfollowing) != 0:
-                user.set_changed()
-                self._notify_new_following(user, new_following)
-                self._notify_new_unfollowing(user, new_unfollowing)
+            self._save_from_users(users, changes, observed_at, failed)
+        finally:
+            stop.set()
+            UserDocument.release_leases(self.config.WORKER_ID, [
+                                        user["document"].pk for user in progress["users"]])
 
-        self._add_usernames_to_saved_progress(progress["list"])
-        self._save_from_users(progress["users"])
+        self._notify_pending_following()
@@ -0,0 +1,257 @@
+from typing import Callable, Dict, Optional, Tuple, TypeVar
+from email.utils import parsedate_to_datetime
+from http.client import IncompleteRead
+from threading import Lock
+from time import monotonic, sleep, time
+from requests.exceptions import ConnectionError, Timeout, ChunkedEncodingError  # type: ignore
+from urllib3.exceptions import ProtocolError  # type: ignore
+import logging
+import random
+
+T = TypeVar("T")
+
+RETRYABLE_STATUS = (429, 500, 502, 503, 504)
+TRANSIENT_ERRORS = (ConnectionError, Timeout, ChunkedEncodingError,
+                    ProtocolError, IncompleteRead, ConnectionResetError)
+
+
+class UpstreamError(Exception):
+    """Non ok response of an upstream API
+    """
+    status_code: int
+    retry_after: Optional[float]
+
+    def __init__(self, message: str, status_code: int, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class CircuitOpen(Exception):
+    """Raised instead of calling an upstream that failed too often recently
+    """
+    upstream: str
+    retry_after: float
+
+    def __init__(self, upstream: str, retry_after: float):
+        super().__init__(
+            f"Circuit of {upstream} is open. Retry after {retry_after:.0f} seconds")
+        self.upstream = upstream
+        self.retry_after = retry_after
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Parse Retry-After header, either seconds or HTTP date
+
+    Args:
+        value (Optional[str]): Header value
+
+    Returns:
+        Optional[float]: Seconds to wait. None if header is missing or invalid
+    """
+    if value is None:
+        return None
+
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time(), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+def classify(error: Exception) -> Tuple[bool, Optional[float]]:
+    """Decide whether a failed call may succeed when retried
+
+    Args:
+        error (Exception): Raised error
+
+    Returns:
+        Tuple[bool, Optional[float]]: Whether error is transient and the seconds the upstream asked to wait
+    """
+    if isinstance(error, UpstreamError):
+        return error.status_code in RETRYABLE_STATUS, error.retry_after
+
+    # Tweepy HTTPException and requests HTTPError carry the response
+    response = getattr(error, "response", None)
+    status_code = getattr(response, "status_code", None)
+
+    if status_code is not None:
+        return status_code in RETRYABLE_STATUS, parse_retry_after(response.headers.get("retry-after"))
+
+    if isinstance(error, TRANSIENT_ERRORS):
+        return True, None
+
+    return False, None
+
+
+class CircuitBreaker:
+    """Stops calling an upstream after failure_threshold consecutive transient failures.
+    After reset_timeout one trial call is let through, which closes the circuit when it succeeds
+    """
+    upstream: str
+    failure_threshold: int
+    reset_timeout: float
+    _failures: int
+    _opened_at: Optional[float]
+    _trial: bool
+    _lock: Lock
+
+    def __init__(self, upstream: str, failure_threshold: int = 5, reset_timeout: float = 60):
+        self.upstream = upstream
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._trial = False
+        self._lock = Lock()
+
+    def before_call(self):
+        """Check that upstream may be called
+
+        Raises:
+            CircuitOpen: Circuit is open, or the trial call is in progress
+        """
+        with self._lock:
+            if self._opened_at is None:
+                return
+
+            remaining = self._opened_at + self.reset_timeout - monotonic()
+
+            if remaining > 0 or self._trial:
+                raise CircuitOpen(self.upstream, max(remaining, 0))
+
+            self._trial = True
+
+    def record_success(self):
+        with self._lock:
+            if self._opened_at is not None:
+                logging.info(f"Circuit of {self.upstream} is closed")
+
+            self._failures = 0
+            self._opened_at = None
+            self._trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+
+            if self._trial or self._failures >= self.failure_threshold:
+                if self._opened_at is None or self._trial:
+                    logging.warning(
+                        f"Circuit of {self.upstream} is open for {self.reset_timeout:.0f} seconds after {self._failures} failures")
+                self._opened_at = monotonic()
+                self._trial = False
+
+    def record_ignored(self):
+        """Release trial call that ended with a non transient error
+        """
+        with self._lock:
+            self._trial = False
+
+
+class RetryPolicy:
+    """Retries transient failures of one upstream with jittered exponential backoff.
+    Retry-After of the upstream is honored. A longer wait than max_backoff is left to the caller
+    """
+    upstream: str
+    max_attempts: int
+    base_backoff: float
+    max_backoff: float
+    breaker: CircuitBreaker
+
+    def __init__(self, upstream: str, max_attempts: int = 5, base_backoff: float = 1, max_backoff: float = 60):
+        self.upstream = upstream
+        self.max_attempts = max_attempts
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.breaker = CircuitBreaker(upstream)
+
+    def backoff(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        """Get seconds to wait before the next attempt
+
+        Args:
+            attempt (int): Failed attempts so far, starting from 1
+            retry_after (Optional[float], optional): Seconds the upstream asked to wait. Defaults to None.
+
+        Returns:
+            float: Seconds to wait
+        """
+        delay = random.uniform(0, min(self.base_backoff * 2 **
+                               (attempt - 1), self.max_backoff))
+
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+
+        return min(delay, self.max_backoff)
+
+    def call(self, fn: Callable[[], T]) -> T:
+        """Call upstream and retry transient failures. Other errors are raised right away and do not count as failures.
+        Transient errors whose Retry-After is longer than max_backoff are raised too, so the caller schedules the retry
+
+        Args:
+            fn (Callable[[], T]): Upstream call
+
+        Raises:
+            CircuitOpen: Upstream failed too often recently
+            Exception: Error that is not transient, or the last transient error
+
+        Returns:
+            T: Result of fn
+        """
+        attempt = 0
+
+        while True:
+            attempt += 1
+            self.breaker.before_call()
+
+            try:
+                result = fn()
+            except Exception as e:
+                transient, retry_after = classify(e)
+
+                if not transient:
+                    self.breaker.record_ignored()
+                    raise
+
+                # Upstream that tells how long to wait is throttling, not failing
+                if retry_after is None:
+                    self.breaker.record_failure()
+                else:
+                    self.breaker.record_ignored()
+
+                if attempt >= self.max_attempts or (retry_after is not None and retry_after > self.max_backoff):
+                    raise
+
+                delay = self.backoff(attempt, retry_after)
+                logging.warning(
+                    f"{self.upstream} call failed with {type(e).__name__}, attempt {attempt}. Retrying in {delay:.1f} seconds")
+                sleep(delay)
+                continue
+
+            self.breaker.record_success()
+
+            return result
+
+
+_policies: Dict[str, RetryPolicy] = {}
+_policies_lock = Lock()
+
+
+def get_policy(upstream: str) -> RetryPolicy:
+    """Get retry policy of an upstream. Every client of the same upstream shares its circuit breaker
+
+    Args:
+        upstream (str): Upstream name
+
+    Returns:
+        RetryPolicy: Shared policy
+    """
+    with _policies_lock:
+        if upstream not in _policies:
+            _policies[upstream] = RetryPolicy(upstream)
+
+        return _policies[upstream]
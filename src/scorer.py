@@ -1,8 +1,11 @@
 
-from typing import Dict, List, Set, TypedDict
+from typing import Dict, List, Optional, Set, Tuple, TypedDict
 from datetime import datetime, timedelta
+from collections import deque
+from bisect import bisect_left, bisect_right
 from pytz import UTC  # type: ignore
-import re
+from src.cache import TTLCache
+import numpy as np  # type: ignore
 
 
 class Word(TypedDict):
@@ -15,23 +18,225 @@ class Account(TypedDict):
     points: int
 
 
+class BatchScore(TypedDict):
+    followers_count_points: np.ndarray
+    created_at_points: np.ndarray
+    description_points: np.ndarray
+    url_points: np.ndarray
+    urls: List[List[str]]
+
+
+class KeywordMatcher:
+    """Word level Aho-Corasick automaton over keyword phrases. Scores every occurrence
+    of every keyword in a description with one pass over its words.
+    """
+    _goto: List[Dict[str, int]]
+    _fail: List[int]
+    _points: List[int]
+
+    def __init__(self, keywords: List[Word]):
+        self._goto = [{}]
+        self._fail = [0]
+        self._points = [0]
+
+        for keyword in keywords:
+            node = 0
+
+            for word in keyword["word"].split(" "):
+                child = self._goto[node].get(word)
+
+                if child is None:
+                    child = len(self._goto)
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._points.append(0)
+                    self._goto[node][word] = child
+
+                node = child
+
+            self._points[node] += keyword["points"]
+
+        # Breadth first so fail target is complete before its points are added
+        queue = deque(self._goto[0].values())
+
+        while queue:
+            node = queue.popleft()
+
+            for word, child in self._goto[node].items():
+                queue.append(child)
+
+                fail = self._fail[node]
+                while fail != 0 and word not in self._goto[fail]:
+                    fail = self._fail[fail]
+
+                self._fail[child] = self._goto[fail].get(word, 0)
+                self._points[child] += self._points[self._fail[child]]
+
+    def score(self, words: List[str]) -> int:
+        """Sum points of every keyword occurrence
+
+        Args:
+            words (List[str]): Lowercase description words
+
+        Returns:
+            int: Keyword points
+        """
+        node = 0
+        points = 0
+
+        for word in words:
+            while node != 0 and word not in self._goto[node]:
+                node = self._fail[node]
+
+            node = self._goto[node].get(word, 0)
+            points += self._points[node]
+
+        return points
+
+
+class UrlClassifier:
+    """Classify profile URLs by host. Known domains are matched by longest suffix in a
+    reversed label trie, blacklisted brands by any host label. Host classification is memoized.
+    """
+    DISCORD = "discord"
+    TELEGRAM = "telegram"
+    ALLOWED = "allowed"
+    BLACKLISTED = "blacklisted"
+
+    POINTS = {DISCORD: 40, TELEGRAM: 10, ALLOWED: 20, BLACKLISTED: 0}
+
+    DOMAINS = {
+        "discord.gg": DISCORD,
+        "discord.com": DISCORD,
+        "discordapp.com": DISCORD,
+        "t.me": TELEGRAM,
+        "telegram.me": TELEGRAM,
+        "telegram.org": TELEGRAM
+    }
+
+    _trie: Dict
+    _labels: Set[str]
+    _hosts: TTLCache
+
+    def __init__(self, blacklist: List[str], cache_size: int = 10000):
+        self._trie = {}
+        self._labels = set()
+        self._hosts = TTLCache(cache_size)
+
+        for domain, kind in self.DOMAINS.items():
+            self._add_domain(domain, kind)
+
+        for entry in blacklist:
+            if "." in entry:
+                self._add_domain(entry.lower(), self.BLACKLISTED)
+            else:
+                self._labels.add(entry.lower())
+
+    def _add_domain(self, domain: str, kind: str):
+        node = self._trie
+
+        for label in reversed(domain.split(".")):
+            node = node.setdefault(label, {})
+
+        node[""] = kind
+
+    @staticmethod
+    def split(url: str) -> Tuple[str, str]:
+        """Split URL into normalized host and path
+
+        Args:
+            url (str): URL with or without scheme
+
+        Returns:
+            Tuple[str, str]: Lowercase host without www and port, path without query and fragment
+        """
+        url = url.strip()
+
+        if "://" in url:
+            url = url.split("://", 1)[1]
+
+        host, _, path = url.partition("/")
+        host = host.rsplit("@", 1)[-1].split(":", 1)[0].lower().rstrip(".")
+
+        if host.startswith("www."):
+            host = host[4:]
+
+        return host, path.split("?", 1)[0].split("#", 1)[0]
+
+    def classify_host(self, host: str) -> str:
+        """Classify normalized host
+
+        Args:
+            host (str): Normalized host, see split
+
+        Returns:
+            str: DISCORD, TELEGRAM, BLACKLISTED or ALLOWED
+        """
+        kind = self._hosts.get(host)
+
+        if kind is None:
+            kind = self._classify_host(host)
+            self._hosts.set(host, kind)
+
+        return kind
+
+    def _classify_host(self, host: str) -> str:
+        labels = host.split(".")
+        node = self._trie
+        kind = None
+
+        for label in reversed(labels):
+            if label not in node:
+                break
+            node = node[label]
+            kind = node.get("", kind)
+
+        if kind is not None:
+            return kind
+
+        if any(label in self._labels for label in labels):
+            return self.BLACKLISTED
+
+        return self.ALLOWED
+
+    def classify(self, url: str) -> str:
+        """Classify URL. Discord and Telegram links only count as invite with invite code in the path
+
+        Args:
+            url (str): URL with or without scheme
+
+        Returns:
+            str: DISCORD, TELEGRAM, BLACKLISTED or ALLOWED
+        """
+        host, path = self.split(url)
+        kind = self.classify_host(host)
+
+        if kind == self.DISCORD and len(path.strip("/")) < 2:
+            return self.ALLOWED
+
+        if kind == self.TELEGRAM and len(path.split("/", 1)[0]) < 5:
+            return self.ALLOWED
+
+        return kind
+
+
 class Scorer:
     keywords: Dict[int, List[Word]]
+    keyword_matcher: KeywordMatcher
     accounts: Dict[str, int]
     followers: Dict[int, int]
     creation_date: Dict[int, int]
     url_blacklist: List[str]
+    url_classifier: UrlClassifier
+    _followers_offsets: List[int]
+    _followers_points: np.ndarray
+    _creation_date_offsets: List[float]
+    _creation_date_points: np.ndarray
+    score_cache: TTLCache
+    _signature: int
 
-    def __init__(self, wordlist: List[Dict], accounts: List[Dict]):
-        sanitized = self._sanitize(wordlist)
-        self.keywords = {}
-
-        for keyword in sanitized:
-            word_count = len(keyword["word"].split(" "))
-            if word_count in self.keywords:
-                self.keywords[word_count].append(keyword)
-            else:
-                self.keywords[word_count] = [keyword]
+    def __init__(self, wordlist: List[Dict], accounts: List[Dict], cache_size: int = 10000):
+        self.set_keywords(wordlist, build=False)
 
         self.accounts = {}
 
@@ -80,6 +285,72 @@ class Scorer:
             "fb.me", "facebook", "twitter", "instagram", "youtube", "wa.me", "whatsapp", "linkedin", "tiktok", "fb.com"
         ]
 
+        self.score_cache = TTLCache(cache_size)
+        self._build()
+
+    def _tables_signature(self) -> int:
+        return hash((
+            tuple((word_count, tuple((word["word"], word["points"]) for word in words))
+                  for word_count, words in sorted(self.keywords.items())),
+            tuple(self.followers.items()),
+            tuple(self.creation_date.items()),
+            tuple(self.url_blacklist)
+        ))
+
+    def _build(self):
+        """Build lookups from keyword and scoring tables and drop cached scores
+        """
+        self.keyword_matcher = KeywordMatcher(
+            [word for words in self.keywords.values() for word in words])
+
+        # Bucket upper bounds and their points, last point is for values above every bound
+        self._followers_offsets = sorted(self.followers.keys())
+        self._followers_points = np.array(
+            [self.followers[offset] for offset in self._followers_offsets] + [4])
+
+        self._creation_date_offsets = [timedelta(weeks=offset).total_seconds()
+                                       for offset in sorted(self.creation_date.keys())]
+        self._creation_date_points = np.array(
+            [self.creation_date[offset] for offset in sorted(self.creation_date.keys())] + [6])
+
+        self.url_classifier = UrlClassifier(self.url_blacklist)
+
+        self.score_cache.clear()
+        self._signature = self._tables_signature()
+
+    def _refresh(self):
+        """Rebuild lookups if any table has been changed since the last build
+        """
+        if self._signature != self._tables_signature():
+            self._build()
+
+    def set_keywords(self, wordlist: List[Dict], build: bool = True):
+        """Replace keyword table
+
+        Args:
+            wordlist (List[Dict]): Airtable keyword rows
+            build (bool, optional): Rebuild lookups and drop cached scores. Defaults to True.
+        """
+        self.keywords = {}
+
+        for keyword in self._sanitize(wordlist):
+            word_count = len(keyword["word"].split(" "))
+            if word_count in self.keywords:
+                self.keywords[word_count].append(keyword)
+            else:
+                self.keywords[word_count] = [keyword]
+
+        if build:
+            self._build()
+
+    def cache_info(self) -> Dict[str, int]:
+        """Score cache statistics
+
+        Returns:
+            Dict[str, int]: hits, misses and size of score cache
+        """
+        return {"hits": self.score_cache.hits, "misses": self.score_cache.misses, "size": len(self.score_cache)}
+
     def _sanitize(self, wordlist: List[Dict]):
         words: Set[str] = set()
         result: List[Word] = []
@@ -93,34 +364,18 @@ class Scorer:
         return result
 
     def get_followers_point(self, followers_count: int):
-        for offset in self.followers.keys():
-            if followers_count <= offset:
-                return self.followers[offset]
+        return int(self._followers_points[bisect_left(self._followers_offsets, followers_count)])
 
-        return 4
+    def get_timedelta_point(self, date: datetime, now: Optional[datetime] = None):
+        if now is None:
+            now = datetime.utcnow().replace(tzinfo=UTC)
 
-    def get_timedelta_point(self, date: datetime):
-        for offset in self.creation_date.keys():
-            if date > datetime.utcnow().replace(tzinfo=UTC) - timedelta(weeks=offset):
-                return self.creation_date[offset]
+        age = (now - date).total_seconds()
 
-        return 6
+        return int(self._creation_date_points[bisect_right(self._creation_date_offsets, age)])
 
     def get_keyword_point(self, description: str):
-
-        words = description.lower().split(" ")
-        points = 0
-
-        for wordlength in self.keywords.keys():
-            phrases = [' '.join(words[i:i+wordlength])
-                       for i in range(len(words)-wordlength)]
-
-            for phrase in phrases:
-                for word in self.keywords[wordlength]:
-                    if word["word"] == phrase:
-                        points += word["points"]
-
-        return points
+        return self.keyword_matcher.score(description.lower().split(" "))
 
     def get_username_point(self, username: str):
 
@@ -130,35 +385,73 @@ class Scorer:
         return 0
 
     def get_url_point(self, urls: List[str]):
-        discord_invite = r'discord(?:\.com|app\.com|\.gg)[\/invite\/]?(?:[a-zA-Z0-9\-]{2,32})'
-        telegram_invite = r'(t(elegram)?\.me|telegram\.org)\/([\S]{5,32})\/?'
-
-        regex_discord = re.compile(discord_invite)
-        regex_telegram = re.compile(telegram_invite)
-
         points = 0
         match_urls = []
 
         for url in urls:
-            if len(regex_discord.findall(url)) == 1:
-                points += 40
-                match_urls.append(f"https://{url}")
-            elif len(regex_telegram.findall(url)) == 1:
-                points += 10
-                match_urls.append(f"https://{url}")
-            else:
-                valid = True
-                for blacklist_url in self.url_blacklist:
-                    if blacklist_url in url:
-                        valid = False
-                        break
+            kind = self.url_classifier.classify(url)
+            points += UrlClassifier.POINTS[kind]
 
-                if valid:
-                    points += 20
-                    match_urls.append(f"https://{url}")
+            if kind != UrlClassifier.BLACKLISTED:
+                match_urls.append(f"https://{url}")
 
         return points, match_urls
 
+    def score_batch(self, profiles: List[Dict], now: Optional[datetime] = None) -> BatchScore:
+        """Score many profiles at once. Follower count and account age buckets are looked up
+        with one searchsorted each against the same reference time
+
+        Args:
+            profiles (List[Dict]): Profiles with description, followers_count, created_at and urls keys, see TwitterAPI.get_metrics
+            now (Optional[datetime], optional): Reference time of account age. Defaults to now.
+
+        Returns:
+            BatchScore: Points of each component, in profiles order
+        """
+        if now is None:
+            now = datetime.utcnow().replace(tzinfo=UTC)
+
+        self._refresh()
+
+        count = len(profiles)
+
+        followers = np.fromiter(
+            (profile["followers_count"] for profile in profiles), dtype=np.int64, count=count)
+        ages = np.fromiter(((now - profile["created_at"]).total_seconds()
+                           for profile in profiles), dtype=np.float64, count=count)
+
+        followers_buckets = np.searchsorted(
+            self._followers_offsets, followers, side='left')
+        creation_date_buckets = np.searchsorted(
+            self._creation_date_offsets, ages, side='right')
+
+        scores: List[Tuple[int, int, List[str]]] = []
+
+        for profile, followers_bucket, creation_date_bucket in zip(profiles, followers_buckets.tolist(), creation_date_buckets.tolist()):
+            # Bucket points come from the arrays, but keeping buckets in the
+            # fingerprint makes a cached entry describe the whole profile score
+            fingerprint = (profile["description"], tuple(profile["urls"]),
+                           followers_bucket, creation_date_bucket)
+            score = self.score_cache.get(fingerprint)
+
+            if score is None:
+                url_points, urls = self.get_url_point(profile["urls"])
+                score = (self.get_keyword_point(
+                    profile["description"]), url_points, urls)
+                self.score_cache.set(fingerprint, score)
+
+            scores.append(score)
+
+        return BatchScore(
+            followers_count_points=self._followers_points[followers_buckets],
+            created_at_points=self._creation_date_points[creation_date_buckets],
+            description_points=np.fromiter(
+                (score[0] for score in scores), dtype=np.int64, count=count),
+            url_points=np.fromiter(
+                (score[1] for score in scores), dtype=np.int64, count=count),
+            urls=[list(score[2]) for score in scores]
+        )
+
     def get_score(self, description: str, username: str, created_at: datetime, followers_count: int, urls: List[str], inlucde_url=True):
         score = self.get_keyword_point(
             description) + self.get_username_point(username)+self.get_followers_point(followers_count) + self.get_timedelta_point(created_at)
@@ -1,78 +1,469 @@
 from distutils.command.config import config
-from typing import Dict, List
+from typing import Dict, Iterable, List, Optional, Protocol, Tuple
 from tweepy import Client  # type: ignore
 from tweepy.client import Response  # type: ignore
-from tweepy.errors import TooManyRequests  # type: ignore
+from tweepy.errors import BadRequest, TooManyRequests  # type: ignore
+from requests.structures import CaseInsensitiveDict  # type: ignore
 from src import Config
-from time import sleep
-from random import randint
+from src.config import Credential
+from src.cache import TTLCache
+from src.retry import get_policy
+from time import sleep, time
 from datetime import datetime, timedelta
+from threading import Lock
+from array import array
+from bisect import bisect_left
+from sys import intern
+import numpy as np  # type: ignore
 import random
 import logging
+import re
+
+
+class RateLimited(Exception):
+    """Raised by non blocking client when endpoint has no request left in current window
+    """
+    endpoint: str
+    retry_after: float
+
+    def __init__(self, endpoint: str, retry_after: float):
+        super().__init__(
+            f"Rate limit reached for {endpoint}. Retry after {retry_after:.0f} seconds")
+        self.endpoint = endpoint
+        self.retry_after = retry_after
+
+
+class Bucket:
+    limit: int
+    remaining: int
+    reset: float
+
+    def __init__(self, limit: int, remaining: int, reset: float):
+        self.limit = limit
+        self.remaining = remaining
+        self.reset = reset
+
+
+class RateLimiter:
+    """Token bucket per endpoint, refilled from x-rate-limit-* response headers.
+    Shared by every client that uses the same credentials.
+    """
+    DEFAULT_WINDOW = 15*60
+
+    _lock: Lock
+    _buckets: Dict[str, Bucket]
+
+    def __init__(self):
+        self._lock = Lock()
+        self._buckets = {}
+
+    @staticmethod
+    def endpoint_key(method: str, route: str, user_auth: bool) -> str:
+        """Normalize request into endpoint key. Path ids are dropped since limit is per endpoint
+
+        Args:
+            method (str): HTTP method
+            route (str): API route
+            user_auth (bool): Whether request uses user context auth
+
+        Returns:
+            str: Endpoint key
+        """
+        return f"{method} {re.sub(r'(?<=.)/[0-9]+(?=/|$)', '/:id', route)}{' user' if user_auth else ''}"
+
+    @staticmethod
+    def _reserved(bucket: Bucket, share: float) -> int:
+        """Get requests of the window that are kept for clients with a larger share
+        """
+        return int(max(bucket.limit, 0) * (1 - share))
+
+    def wait_time(self, endpoint: str, share: float = 1.0) -> float:
+        """Get seconds to wait before endpoint can be requested again
+
+        Args:
+            endpoint (str): Endpoint key
+            share (float, optional): Fraction of the window limit the caller may use. Defaults to 1.0.
+
+        Returns:
+            float: Seconds to wait. Zero if a request is available
+        """
+        with self._lock:
+            bucket = self._buckets.get(endpoint)
+
+            if bucket is None or bucket.remaining > self._reserved(bucket, share) or bucket.reset <= time():
+                return 0
+
+            return bucket.reset - time() + 1
+
+    def acquire(self, endpoint: str, share: float = 1.0) -> bool:
+        """Take one request from endpoint bucket
+
+        Args:
+            endpoint (str): Endpoint key
+            share (float, optional): Fraction of the window limit the caller may use. Requests
+                of the rest of the window are left for other callers. Defaults to 1.0.
+
+        Returns:
+            bool: Whether request has been acquired. False if bucket is empty until window reset
+        """
+        with self._lock:
+            bucket = self._buckets.get(endpoint)
+            now = time()
+
+            if bucket is None:
+                return True
+
+            if bucket.reset <= now:
+                if bucket.limit <= 0:
+                    # Window size is unknown, next response headers will tell
+                    del self._buckets[endpoint]
+                    return True
+
+                bucket.remaining = bucket.limit
+                bucket.reset = now + self.DEFAULT_WINDOW
+
+            if bucket.remaining > self._reserved(bucket, share):
+                bucket.remaining -= 1
+                return True
+
+            return False
+
+    def update(self, endpoint: str, headers: CaseInsensitiveDict, limited: bool = False):
+        """Refill endpoint bucket from response headers
+
+        Args:
+            endpoint (str): Endpoint key
+            headers (CaseInsensitiveDict): Response headers
+            limited (bool, optional): Whether the response was 429. Defaults to False.
+        """
+        try:
+            reset = float(headers["x-rate-limit-reset"])
+            remaining = int(headers["x-rate-limit-remaining"])
+            limit = int(headers.get("x-rate-limit-limit", remaining))
+        except (KeyError, ValueError):
+            if not limited:
+                return
+            reset = time() + self.DEFAULT_WINDOW
+            remaining = 0
+            limit = 0
+
+        if limited:
+            remaining = 0
+
+        with self._lock:
+            bucket = self._buckets.get(endpoint)
+
+            if bucket is None or reset > bucket.reset:
+                self._buckets[endpoint] = Bucket(limit, remaining, reset)
+            else:
+                # Responses of concurrent requests can arrive out of order
+                bucket.remaining = min(bucket.remaining, remaining)
+
+
+class PooledCredential:
+    credential: Credential
+    rate_limiter: RateLimiter
+
+    def __init__(self, credential: Credential):
+        self.credential = credential
+        self.rate_limiter = RateLimiter()
+
+
+class CredentialPool:
+    """Pool of Twitter credential sets, each with its own rate limiter.
+    Requests are spread round-robin per endpoint and fail over to the next
+    credential when one of them is limited.
+    """
+    credentials: List[PooledCredential]
+    _lock: Lock
+    _cursors: Dict[str, int]
+
+    def __init__(self, credentials: List[Credential]):
+        self.credentials = [PooledCredential(credential)
+                            for credential in credentials]
+        self._lock = Lock()
+        self._cursors = {}
+
+    def acquire(self, endpoint: str, blocking: bool = True, share: float = 1.0) -> PooledCredential:
+        """Take one request of endpoint from the next credential that has budget left
+
+        Args:
+            endpoint (str): Endpoint key
+            blocking (bool, optional): Sleep until the earliest window reset when every credential is limited. Defaults to True.
+            share (float, optional): Fraction of every credential window the caller may use. Defaults to 1.0.
+
+        Raises:
+            RateLimited: Every credential is limited and blocking is False
+
+        Returns:
+            PooledCredential: Credential to send request with
+        """
+        while True:
+            with self._lock:
+                start = self._cursors.get(endpoint, 0)
+                self._cursors[endpoint] = (start + 1) % len(self.credentials)
+
+            for i in range(len(self.credentials)):
+                pooled = self.credentials[(start + i) % len(self.credentials)]
+
+                if pooled.rate_limiter.acquire(endpoint, share):
+                    return pooled
+
+            wait = min(pooled.rate_limiter.wait_time(endpoint, share)
+                       for pooled in self.credentials)
+
+            if not blocking:
+                raise RateLimited(endpoint, wait)
+
+            logging.warning(
+                f"Rate limit reached for {endpoint} on every credential. Waiting {wait:.0f} seconds")
+            sleep(wait)
+
+    def get_client(self, blocking: bool = True, share: float = 1.0) -> Client:
+        """Create client that draws its credentials from this pool
+
+        Args:
+            blocking (bool, optional): Wait for window reset instead of raising RateLimited. Defaults to True.
+            share (float, optional): Fraction of every rate limit window the client may use. Defaults to 1.0.
+
+        Returns:
+            Client: Tweepy API Client
+        """
+        return RateLimitedClient(self, blocking=blocking, share=share)
+
+
+class RateLimitedClient(Client):
+    """Tweepy client that picks credential from CredentialPool for every request.
+    Not thread safe, create one client per worker.
+    """
+    pool: CredentialPool
+    blocking: bool
+    share: float
+
+    def __init__(self, pool: CredentialPool, blocking: bool = True, share: float = 1.0):
+        super().__init__()
+        self.pool = pool
+        self.blocking = blocking
+        self.share = share
+
+    def request(self, method, route, params=None, json=None, user_auth=False):
+        # Transient errors are retried by the Twitter retry policy, rate limit by the pool
+        return get_policy("twitter").call(lambda: self._request(method, route, params, json, user_auth))
+
+    def _request(self, method, route, params=None, json=None, user_auth=False):
+        endpoint = RateLimiter.endpoint_key(method, route, user_auth)
+
+        while True:
+            pooled = self.pool.acquire(endpoint, self.blocking, self.share)
+
+            self.bearer_token = pooled.credential["bearer_token"]
+            self.consumer_key = pooled.credential["consumer_key"]
+            self.consumer_secret = pooled.credential["consumer_secret"]
+            self.access_token = pooled.credential["access_token"]
+            self.access_token_secret = pooled.credential["access_token_secret"]
+
+            try:
+                response = super().request(method, route, params, json, user_auth)
+            except TooManyRequests as e:
+                pooled.rate_limiter.update(
+                    endpoint, e.response.headers, limited=True)
+                continue
+
+            pooled.rate_limiter.update(endpoint, response.headers)
+
+            return response
+
+
+class Account:
+    """Followed account. Usernames are interned since the same account is followed by many tracked users
+    """
+    __slots__ = ('user_id', 'username', 'name')
+
+    user_id: int
+    username: str
+    name: str
+
+    def __init__(self, user_id: int, username: str, name: str):
+        self.user_id = user_id
+        self.username = intern(username)
+        self.name = name
+
+
+class Following:
+    """Following list as sorted id array. Username and name are only kept for accounts
+    fetched by this process, stored snapshots only need the ids.
+    """
+    __slots__ = ('ids', 'accounts')
+
+    ids: array
+    accounts: Dict[int, Account]
+
+    def __init__(self, ids: Iterable[int] = (), accounts: Iterable[Account] = ()):
+        self.accounts = {account.user_id: account for account in accounts}
+
+        if isinstance(ids, array) and ids.typecode == 'q' and len(ids) > 0:
+            id_array = np.frombuffer(ids, dtype=np.int64)
+        else:
+            id_array = np.fromiter(ids, dtype=np.int64)
+
+        merged = np.unique(np.concatenate([id_array, np.fromiter(
+            self.accounts, dtype=np.int64, count=len(self.accounts))]))
+
+        self.ids = array('q', merged.tobytes())
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __contains__(self, user_id: int) -> bool:
+        index = bisect_left(self.ids, user_id)
+        return index < len(self.ids) and self.ids[index] == user_id
+
+    def as_numpy(self) -> np.ndarray:
+        """Zero copy numpy view of the ids
+
+        Returns:
+            np.ndarray: Sorted int64 ids
+        """
+        if len(self.ids) == 0:
+            return np.empty(0, dtype=np.int64)
+
+        return np.frombuffer(self.ids, dtype=np.int64)
+
+    def diff(self, old: 'Following') -> Tuple[List[int], List[int]]:
+        """Compare with older following list in one searchsorted pass over both sorted arrays
+
+        Args:
+            old (Following): Older following list
+
+        Returns:
+            Tuple[List[int], List[int]]: ids only in this list (followed) and ids only in old (unfollowed)
+        """
+        new_ids = self.as_numpy()
+        old_ids = old.as_numpy()
+
+        if len(old_ids) == 0 or len(new_ids) == 0:
+            return new_ids.tolist(), old_ids.tolist()
+
+        positions = np.searchsorted(old_ids, new_ids)
+        clipped = np.minimum(positions, len(old_ids) - 1)
+        found = old_ids[clipped] == new_ids
+
+        kept = np.zeros(len(old_ids), dtype=bool)
+        kept[clipped[found]] = True
+
+        return new_ids[~found].tolist(), old_ids[~kept].tolist()
+
+    def usernames(self, ids: Iterable[int]) -> List[str]:
+        """Get usernames of ids. Ids without known username are skipped
+
+        Args:
+            ids (Iterable[int]): Account ids
+
+        Returns:
+            List[str]: Usernames
+        """
+        return [self.accounts[id].username for id in ids if id in self.accounts]
 
 
 class User:
+    __slots__ = ('user_id', 'username', 'name', 'following', 'changed')
+
     user_id: int
     username: str
     name: str
-    following: List = []
-    changed = False
+    following: Following
+    changed: bool
 
-    def __init__(self, id: int, username: str, name: str, following: List = None):
+    def __init__(self, id: int, username: str, name: str, following: Following = None):
         self.user_id = id
         self.username = username
         self.name = name
+        self.following = following if following is not None else Following()
+        self.changed = False
+
+    def get_following(self, client: Client, incremental: bool = False, checkpoint: Optional["CheckpointStore"] = None):
+        """Get list of user following. It's result will be saved in following property.
+        Rate limit is handled by the client, see RateLimitedClient
 
-        if following is not None:
-            self.following = following
+        Twitter returns following newest first, so incremental fetch stops paginating at the
+        first account that is already in the following property and adds the newer ones.
+        Unfollowing is only detected by full fetch.
 
-    def get_following(self, client: Client):
-        """Get list of user following. It's result will be saved in following property
+        With checkpoint, pagination token and fetched accounts are saved after every page,
+        so a fetch that was interrupted resumes from the last completed page. If Twitter rejects
+        the saved token, the checkpoint is dropped and the fetch restarts from the first page.
 
         Args:
             client (Client): Tweepy API Client
+            incremental (bool, optional): Stop at the first known following. Defaults to False.
+            checkpoint (Optional[CheckpointStore], optional): Pagination checkpoint store. Defaults to None.
         """
-        self.following: List[User] = []
-        current_client = client
+        following: List[Account] = []
 
         payload: Dict = {}
 
-        while True:
+        if checkpoint is not None:
+            saved = checkpoint.load_checkpoint(self.user_id, incremental)
+
+            if saved is None:
+                checkpoint.clear_checkpoint(self.user_id)
+            else:
+                payload["pagination_token"], following = saved[0], list(
+                    saved[1])
+                logging.info(
+                    f"Resuming {self.username} following after {len(following)} fetched accounts")
+
+        resumed = "pagination_token" in payload
 
+        while True:
             try:
-                response: Response = current_client.get_users_following(
+                response: Response = client.get_users_following(
                     self.user_id, user_auth=True, max_results=999, **payload)
+            except BadRequest:
+                # Only Twitter rejecting the token invalidates the checkpoint, other errors keep it for the next run
+                if not resumed or checkpoint is None:
+                    raise
 
-                twitter_users: List[Dict] = response.data
+                logging.warning(
+                    f"Saved pagination token of {self.username} is rejected. Restarting from the first page")
+                checkpoint.clear_checkpoint(self.user_id)
+                payload, following, resumed = {}, [], False
+                continue
 
-                for user in twitter_users:
-                    self.following.append(
-                        User(user["id"], user["username"], user["name"]))
+            resumed = False
 
-                meta: Dict = response.meta
+            twitter_users: List[Dict] = response.data or []
+            page_start = len(following)
 
-                if "next_token" in meta:
-                    payload["pagination_token"] = meta["next_token"]
-                else:
-                    break
+            for user in twitter_users:
+                user_id = int(user["id"])
 
-                sleep(randint(1, 3))
+                if incremental and user_id in self.following:
+                    self.following = Following(
+                        self.following.ids, [*self.following.accounts.values(), *following])
 
-            except TooManyRequests:
-                logging.warning(
-                    'Request limit reached. Waiting for 20 minutes')
-                sleep(20*60)
-                current_client = Client(bearer_token=client.bearer_token, consumer_key=client.consumer_key,
-                                        consumer_secret=client.consumer_secret, access_token=client.access_token, access_token_secret=client.access_token_secret)
+                    if checkpoint is not None:
+                        checkpoint.clear_checkpoint(self.user_id)
+                    return
 
-    @property
-    def following_usernames(self) -> List[str]:
-        """List of user following usernames
+                following.append(
+                    Account(user_id, user["username"], user["name"]))
 
-        Returns:
-            List[str]: List of username
-        """
-        return [user.username for user in self.following]
+            meta: Dict = response.meta
+
+            if "next_token" in meta:
+                payload["pagination_token"] = meta["next_token"]
+
+                if checkpoint is not None:
+                    checkpoint.save_checkpoint(
+                        self.user_id, incremental, meta["next_token"], following[page_start:])
+            else:
+                break
+
+        if checkpoint is not None:
+            checkpoint.clear_checkpoint(self.user_id)
+
+        self.following = Following(accounts=following)
 
     def set_changed(self):
         """Set that user class data has changed
@@ -88,18 +479,18 @@ class User:
         """Convert user class to dictionary
 
         Returns:
-            Dict: Dictionary with user_id, username, name, and following as its keys
+            Dict: Dictionary with user_id, username, name, and following ids as its keys
         """
         return {
             "user_id": self.user_id,
             "username": self.username,
             "name": self.name,
-            "following": [user.to_dict() for user in self.following]
+            "following": self.following.ids.tolist()
         }
 
     @classmethod
     def from_dict(cls, data: Dict):
-        """Convert dictionary data to user class
+        """Convert dictionary data to user class. Following can be list of ids or list of user dictionary
 
         Args:
             data (Dict): User data
@@ -113,7 +504,17 @@ class User:
         if "user_id" not in data and "username" not in data and "name" not in data and "following" not in data:
             raise Exception('Invalid User data')
 
-        return cls(data["user_id"], data["username"], data["name"], following=[cls.from_dict(user) for user in data["following"]])
+        ids: List[int] = []
+        accounts: List[Account] = []
+
+        for following in data["following"]:
+            if isinstance(following, dict):
+                accounts.append(Account(
+                    following["user_id"], following["username"], following["name"]))
+            else:
+                ids.append(following)
+
+        return cls(data["user_id"], data["username"], data["name"], following=Following(ids, accounts))
 
     @classmethod
     def from_array(cls, users: List[Dict]):
@@ -128,58 +529,80 @@ class User:
         return [cls.from_dict(user) for user in users]
 
     @staticmethod
-    def new_following(new: List[str], old: List[str]) -> List[str]:
-        """Get new following username from two list
+    def new_following(new: Iterable[int], old: Iterable[int]) -> List[int]:
+        """Get new following ids from two list
 
         Args:
-            new (List[str]): List of new following usernames
-            old (List[str]): List of old following usernames
+            new (Iterable[int]): New following ids
+            old (Iterable[int]): Old following ids
 
         Returns:
-            List[str]: usernames in new that are not in old
+            List[int]: ids in new that are not in old
         """
-        return list(set(new) - set(old))
+        return Following(new).diff(Following(old))[0]
 
     @staticmethod
-    def new_unfollowing(new: List[str], old: List[str]) -> List[str]:
-        """Get new unfollowing username from two list
+    def new_unfollowing(new: Iterable[int], old: Iterable[int]) -> List[int]:
+        """Get new unfollowing ids from two list
 
         Args:
-            new (List[str]): List of new following usernames
-            old (List[str]): List of old following usernames
+            new (Iterable[int]): New following ids
+            old (Iterable[int]): Old following ids
 
         Returns:
-            List[str]: usernames in old that are not in new
+            List[int]: ids in old that are not in new
         """
-        return list(set(old) - set(new))
+        return Following(new).diff(Following(old))[1]
+
+
+class CheckpointStore(Protocol):
+    def load_checkpoint(self, user_id: int, incremental: bool) -> Optional[Tuple[str, List[Account]]]:
+        ...
+
+    def save_checkpoint(self, user_id: int, incremental: bool, pagination_token: str, accounts: List[Account]):
+        ...
+
+    def clear_checkpoint(self, user_id: int):
+        ...
+
+
+class ProfileStore(Protocol):
+    def get_profiles(self, usernames: List[str], max_age: float) -> Dict[str, Tuple[float, Dict]]:
+        ...
+
+    def save_profiles(self, profiles: Dict[str, Dict]):
+        ...
 
 
 class API:
     client: Client
     config: Config
+    pool: CredentialPool
+    profiles: TTLCache
+    profile_store: Optional[ProfileStore]
 
-    def __init__(self, config: Config):
+    def __init__(self, config: Config, profile_store: Optional[ProfileStore] = None):
         self.config = config
-        self.client = Client(config.TWITTER_BEARER_TOKEN, config.TWITTER_CUSTOMER_KEY,
-                             config.TWITTER_CUSTOMER_SECRET, config.TWITTER_OAUTH_TOKEN, config.TWITTER_OAUTH_SECRET)
+        self.pool = CredentialPool(config.TWITTER_CREDENTIALS)
+        self.client = self.pool.get_client()
+        self.profiles = TTLCache(
+            config.PROFILE_CACHE_SIZE, config.PROFILE_CACHE_TTL)
+        self.profile_store = profile_store
 
-    def get_new_client(self) -> Client:
-        config = self.config
-        return Client(config.TWITTER_BEARER_TOKEN, config.TWITTER_CUSTOMER_KEY,
-                      config.TWITTER_CUSTOMER_SECRET, config.TWITTER_OAUTH_TOKEN, config.TWITTER_OAUTH_SECRET)
-
-    def get_users(self, users: List[str]) -> List[User]:
+    def get_users(self, users: List[str], client: Optional[Client] = None) -> List[User]:
         """Get twitter user ids by username
 
         Args:
             users (List[str]): List of twitter username
+            client (Optional[Client], optional): Client for callers on another thread. Defaults to None, which uses the shared client.
         """
         result: List[User] = []
+        client = client if client is not None else self.client
 
         for chunk in [users[i:i+50] for i in range(0, len(users), 50)]:
-            response: Response = self.client.get_users(usernames=chunk)
+            response: Response = client.get_users(usernames=chunk)
 
-            twitter_users: List[Dict] = response.data
+            twitter_users: List[Dict] = response.data or []
 
             for user in twitter_users:
                 result.append(User(user["id"], user["username"], user["name"]))
@@ -203,7 +626,7 @@ class API:
 
         result: List[Dict] = []
 
-        client = self.get_new_client()
+        client = self.pool.get_client(blocking=False)
         counter = 0
 
         while counter <= 3:
@@ -223,30 +646,51 @@ class API:
                 result.extend(response.includes["users"])
                 counter += 1
 
-            except TooManyRequests:
-                logging.info("Tweet crawl limit reached. Skipping")
+            except RateLimited as e:
+                logging.info(
+                    f"Tweet crawl limit reached. Skipping for {e.retry_after:.0f} seconds")
                 break
 
         return [
             item for item in result if item["public_metrics"]["tweet_count"] <= 5]
 
     def get_metrics(self, users: List[str]) -> Dict[str, Dict]:
-        """Get users description and followers count
+        """Get users description and followers count. Profiles are served from the profile cache,
+        then from the profile store, and only the rest is requested from Twitter
 
         Args:
-            users (List[str]): [description]
+            users (List[str]): List of twitter username
 
         Returns:
-            Dict: [description]
+            Dict[str, Dict]: Username to profile metrics. Unknown or suspended users are left out
         """
-        result: List[Dict] = []
+        profiles: Dict[str, Dict] = self.profiles.get_many(
+            username.lower() for username in users)
+        missing = list(dict.fromkeys(
+            username.lower() for username in users if username.lower() not in profiles))
 
-        for chunk in [users[i:i+50] for i in range(0, len(users), 50)]:
+        if self.profile_store is not None and len(missing) != 0:
+            for key, (fetched_at, profile) in self.profile_store.get_profiles(missing, self.config.PROFILE_CACHE_TTL).items():
+                self.profiles.set(key, profile, fetched_at)
+                profiles[key] = profile
+
+            missing = [key for key in missing if key not in profiles]
+
+        fetched: Dict[str, Dict] = {}
+
+        for chunk in [missing[i:i+100] for i in range(0, len(missing), 100)]:
             response = self.client.get_users(
                 usernames=chunk, user_auth=True, user_fields=['public_metrics', 'description', 'created_at', "entities"])
-            result.extend(response.data)
+            fetched.update(self._get_metrics_from_user(response.data or []))
+
+        for username, profile in fetched.items():
+            self.profiles.set(username.lower(), profile)
+            profiles[username.lower()] = profile
+
+        if self.profile_store is not None and len(fetched) != 0:
+            self.profile_store.save_profiles(fetched)
 
-        return self._get_metrics_from_user(result)
+        return {username: profiles[username.lower()] for username in users if username.lower() in profiles}
 
     def _get_metrics_from_user(self, users: List[Dict]):
         metrics = {}
@@ -267,7 +711,9 @@ class API:
                             if "display_url" in url:
                                 urls.append(url["display_url"])
 
-            metrics[user["username"]] = {"description": user["description"],
+            metrics[user["username"]] = {"user_id": int(user["id"]),
+                                         "username": user["username"],
+                                         "description": user["description"],
                                          'followers_count': user["public_metrics"]["followers_count"],
                                          'created_at': user["created_at"],
                                          "urls": urls